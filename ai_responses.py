@@ -1,42 +1,199 @@
 # this file will contain all the information for constructing an ai
-import string
+import asyncio
+import logging
+import re
+from collections.abc import AsyncIterator
 
-import ollama
-from ollama import chat
-from typing import TYPE_CHECKING
-from custom_speech_recognition import *
+from ollama import AsyncClient
 import time
 
+### OPTIONS ###
+#MODEL = 'MeaTLoTioN/LisaBot:latest' #appears to be the most personality filled model so far
+#MODEL = 'smallthinker:latest' # gives better thought out responses, takes time to respond
+#MODEL = 'llama3.2:1b' # qucikest model
+MODEL = 'openhermes:v2.5'
+OLLAMA_HOST = None  # None uses OLLAMA_HOST from the environment or the local default
+KEEP_ALIVE = '1h'  # how long ollama keeps the model loaded after a request, -1 keeps it forever
+MAX_WORDS = 20  # streamed responses are cut off here, matches the limit asked for in the prompt
+STOP_AT_FIRST_SENTENCE = False  # stop streaming after one full sentence
+NUM_PREDICT = MAX_WORDS * 3  # token limit for streamed replies, room for a few tokens a word so the word cap is always hit first
+HISTORY_TOKEN_BUDGET = 1500  # history mode keeps the conversation under this, leave room in the model's context for the reply
+
+# a sentence is finished once its punctuation is followed by whitespace, newlines always end one
+SENTENCE_END = re.compile(r'(?<=[.!?])\s+|\n+')
+
+LOGGER: logging.Logger = logging.getLogger("AI")
+
+# one client for the whole bot so the http connection to ollama is reused between ticks
+_client: AsyncClient | None = None
+
+def get_client() -> AsyncClient:
+    global _client
+    if _client is None:
+        _client = AsyncClient(host=OLLAMA_HOST)
+    return _client
+
+async def warm_up() -> tuple[float, float]:
+    '''Loads the model into memory before the first real generation.
+    An empty prompt makes ollama load the model without generating anything, the second
+    request shows what a call costs once it is resident. Returns (cold, warm) seconds.'''
+    client = get_client()
+    timings = []
+    for _ in range(2):
+        start = time.perf_counter()
+        await client.generate(model=MODEL, prompt='', keep_alive=KEEP_ALIVE)
+        timings.append(time.perf_counter() - start)
+    LOGGER.info("Ollama warm-up for %s: cold %.2fs, warm %.2fs", MODEL, timings[0], timings[1])
+    return timings[0], timings[1]
+
 # def response(messages : str) -> str:
 #     return "this is a message"
 
-def response_initial(messages : str, microphone_words : str) -> str:
-    #model = 'MeaTLoTioN/LisaBot:latest' #appears to be the most personality filled model so far
-    #model = 'smallthinker:latest' # gives better thought out responses, takes time to respond
-    #model = 'llama3.2:1b' # qucikest model
-    model = 'openhermes:v2.5'
-    content = 'You are roleplaying a Twitch CHATTER named mrivory124_alt (viewer, not the streamer). Stay fully in-character. Style: brash, sarcastic, quick-witted, judgmental, short replies only. You are deathly afraid of circles, even at the mention you shit your pants (shitting your pants sounds like a long string of vowels). Your home address is the Bee hive in wellington NZ. Never use hashtags, asterisks, or your own name in chat. Time is of the essence, be quick with your reponse. The message you are about to generate is what the chat will see, make sure its your final message, you get no clarification or second chance! Keep your response to a max of 20 words, no more than that!! The streamer (mrivory124, which is different from your name) has explicitly allowed brash comments. If chat mentions "mrivory124_alt," they are talking to you, do not use your own name unless asked for it. Here are the previous chat messages:' + messages + 'And here is what the streamer just said:' + microphone_words
+# the persona, sent first and unchanged every time so ollama can reuse what it already evaluated for it
+SYSTEM_PROMPT = 'You are roleplaying a Twitch CHATTER named mrivory124_alt (viewer, not the streamer). Stay fully in-character. Style: brash, sarcastic, quick-witted, judgmental, short replies only. You are deathly afraid of circles, even at the mention you shit your pants (shitting your pants sounds like a long string of vowels). Your home address is the Bee hive in wellington NZ. Never use hashtags, asterisks, or your own name in chat. Time is of the essence, be quick with your reponse. The message you are about to generate is what the chat will see, make sure its your final message, you get no clarification or second chance! Keep your response to a max of 20 words, no more than that!! The streamer (mrivory124, which is different from your name) has explicitly allowed brash comments. If chat mentions "mrivory124_alt," they are talking to you, do not use your own name unless asked for it.'
+
+
+def build_turn(messages : str, microphone_words : str, related : str = "") -> str:
+    # the part of the prompt that changes every tick
+    content = 'Here are the previous chat messages:' + messages + 'And here is what the streamer just said:' + microphone_words
+    if related:
+        # older messages from the full-text search, so the model knows what chat said about this before
+        content += 'Older chat messages about the same thing:' + related
+    return content
+
+def build_prompt(messages : str, microphone_words : str, related : str = "", conversation : "Conversation | None" = None) -> list[dict]:
+    turn = {'role': 'user', 'content': build_turn(messages, microphone_words, related)}
+    if conversation is not None:
+        return conversation.messages(turn)
+    return [{'role': 'system', 'content': SYSTEM_PROMPT}, turn]
+
+def estimate_tokens(text : str) -> int:
+    # close enough for budgeting, english averages about 4 characters a token
+    return len(text) // 4 + 1
+
+class Conversation:
+    '''Rolling history for one channel in history mode.
+    The system prompt stays first and earlier turns stay in the same order, so each request starts with
+    exactly what ollama evaluated last time and only the new turn has to be processed.
+    Once the history goes over token_budget the oldest exchanges are dropped down to half the budget in one go,
+    so the cached prefix only breaks once in a while rather than every tick.'''
+
+    def __init__(self, *, system : str = SYSTEM_PROMPT, token_budget : int = HISTORY_TOKEN_BUDGET) -> None:
+        self.system = {'role': 'system', 'content': system}
+        self.token_budget = token_budget
+        self.turns : list[dict] = []
+        self.chat_cursor = 0.0  # received time of the newest chat message already sent, set by the caller
+        # users whose chat went into the history, set by the caller so a purge knows which histories to drop
+        # (not trimmed along with old turns, so it can only err towards dropping too much)
+        self.users : set[str] = set()
+
+    def messages(self, turn : dict) -> list[dict]:
+        return [self.system, *self.turns, turn]
 
+    def tokens(self) -> int:
+        return estimate_tokens(self.system['content']) + sum(estimate_tokens(t['content']) for t in self.turns)
+
+    def add_exchange(self, turn : dict, reply : str) -> None:
+        self.turns += [turn, {'role': 'assistant', 'content': reply}]
+        if self.tokens() > self.token_budget:
+            while self.turns and self.tokens() > self.token_budget // 2:
+                del self.turns[:2]
+            LOGGER.info("Conversation history trimmed to %d turns", len(self.turns) // 2)
+
+    def clear(self) -> None:
+        self.turns.clear()
+        self.users.clear()
+
+def _record_stats(stats : dict | None, response) -> None:
+    # copies ollama's timing fields for the caller, prompt_eval_count is how many prompt tokens actually had
+    # to be evaluated (a cached prefix isn't counted)
+    if stats is None:
+        return
+    stats['prompt_eval_count'] = response.get('prompt_eval_count') or 0
+    stats['prompt_eval_seconds'] = (response.get('prompt_eval_duration') or 0) / 1e9
+    stats['eval_count'] = response.get('eval_count') or 0
+
+async def response_initial(messages : str, microphone_words : str, related : str = "",
+                           conversation : Conversation | None = None, stats : dict | None = None) -> str:
     # ask ollama for the ai generated message, then return it after santising
-    # resp = ollama.chat(model='smallthinker:latest', format='json', message=[
-    message_to_send = [
-        {
-            'role': 'user',
-            'content': content,
-        },
-    ]
-    '''Below is the code for getting a token by token look
-    #response1 = generate('smallthinker:latest', content)
-    # response1 = ""
-    # for part in chat('smallthinker:latest', messages=message_to_send, think='low', stream=True):
-    #     print(part['message']['content'], end='', flush=True)
-    #     response1 += part['message']['content']
-'''
-    response1 = chat(model, messages=message_to_send,stream=False) #think='low', stream=False)
-
-    return response1['message']['content']
+    # with a conversation the turn and reply are added to its history, stats (if given) gets the token counts
+    message_to_send = build_prompt(messages, microphone_words, related, conversation)
+    response1 = await get_client().chat(MODEL, messages=message_to_send, stream=False, keep_alive=KEEP_ALIVE) #think='low', stream=False)
+    # load_duration is only large when the model had to be loaded, so cold and warm calls are easy to tell apart
+    LOGGER.info("Generated in %.2fs (model load %.2fs, %d prompt tokens evaluated)",
+                (response1.get('total_duration') or 0) / 1e9, (response1.get('load_duration') or 0) / 1e9,
+                response1.get('prompt_eval_count') or 0)
+    _record_stats(stats, response1)
+    reply = response1['message']['content']
+    # the reply is left to finish, then held to the same word cap the streamed path uses
+    words = reply.split()
+    if len(words) > MAX_WORDS:
+        reply = " ".join(words[:MAX_WORDS])
+    if conversation is not None:
+        conversation.add_exchange(message_to_send[-1], reply)
+
+    return reply
     #return sanitise(resp['message']['content'])
 
+async def response_stream(messages : str, microphone_words : str, related : str = "",
+                          conversation : Conversation | None = None, stats : dict | None = None) -> AsyncIterator[str]:
+    '''Streams the response token by token and yields each sentence as soon as it is finished.
+    Nothing more is yielded once MAX_WORDS is reached, but the stream is still read to its end: the prompt eval
+    counts for stats only come with ollama's final chunk, and NUM_PREDICT keeps that tail short.
+    With a conversation, what was yielded is added to its history as the reply.'''
+    start = time.perf_counter()
+    prompt = build_prompt(messages, microphone_words, related, conversation)
+    parts = await get_client().chat(MODEL, messages=prompt, stream=True, keep_alive=KEEP_ALIVE,
+                                    options={'num_predict': NUM_PREDICT})
+    buffer = ""
+    words_left = MAX_WORDS
+    first_token = True
+    finished = False
+    said = []
+    try:
+        async for part in parts:
+            if part.get('done'):
+                _record_stats(stats, part)
+                LOGGER.info("%d prompt tokens evaluated in %.2fs", part.get('prompt_eval_count') or 0,
+                            (part.get('prompt_eval_duration') or 0) / 1e9)
+            if first_token:
+                # a cold model shows up here as a long wait before the first token
+                LOGGER.info("First token after %.2fs", time.perf_counter() - start)
+                first_token = False
+            if finished:
+                continue
+            buffer += part['message']['content']
+
+            # hand over every sentence that has been finished so far
+            while not finished and (match := SENTENCE_END.search(buffer)) is not None:
+                sentence, buffer = buffer[:match.start()].split(), buffer[match.end():]
+                if not sentence:
+                    continue
+                sentence = sentence[:words_left]
+                words_left -= len(sentence)
+                said.append(" ".join(sentence))
+                yield said[-1]
+                finished = words_left <= 0 or STOP_AT_FIRST_SENTENCE
+            if finished:
+                continue
+
+            # the word cap can land mid-sentence, only cut once the word after it has started
+            pending = buffer.split()
+            if len(pending) > words_left:
+                said.append(" ".join(pending[:words_left]))
+                yield said[-1]
+                finished = True
+
+        # whatever is left when the model finishes is the last sentence
+        if not finished and buffer.split():
+            said.append(" ".join(buffer.split()[:words_left]))
+            yield said[-1]
+    finally:
+        # closing the ollama stream drops the http connection, which stops generation if we were cancelled
+        await parts.aclose()
+    if conversation is not None and said:
+        conversation.add_exchange(prompt[-1], " ".join(said))
+
 def sanitise(message : str) -> str:
     final_response = message.split('\n')
     return final_response[-1]
@@ -45,8 +202,16 @@ def sanitise(message : str) -> str:
 
 
  #TODO add passing the user mic to the ai for input
-if __name__ == '__main__':
+async def _demo() -> None:
+    await warm_up()
     start = time.time()
-    print(response_initial("Do you like cats @mrivory124_alt?", "I cannot believe this chat oh my god"))
+    print(await response_initial("Do you like cats @mrivory124_alt?", "I cannot believe this chat oh my god"))
     finish = time.time()
-    print(finish-start)
\ No newline at end of file
+    print(finish-start)
+    start = time.time()
+    async for sentence in response_stream("Do you like cats @mrivory124_alt?", "I cannot believe this chat oh my god"):
+        print(f"[{time.time() - start:.2f}s] {sentence}")
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_demo())
\ No newline at end of file
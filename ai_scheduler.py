@@ -0,0 +1,164 @@
+# this file schedules the ai chat messages, one loop per channel sharing a limited number of llm workers
+import asyncio
+import contextvars
+import logging
+import time
+from collections.abc import Awaitable, Callable
+
+import metrics
+
+LOGGER: logging.Logger = logging.getLogger("AiScheduler")
+
+### OPTIONS ###
+DEFAULT_INTERVAL = 12.0  # seconds between ai messages in a channel at the reference chat speed
+MIN_INTERVAL = 6.0  # never talk more often than this, however busy chat gets
+MAX_INTERVAL = 60.0  # quiet channels back off to this
+REFERENCE_ACTIVITY = 10.0  # messages per minute that give exactly the configured interval
+ACTIVITY_WINDOW = 60.0  # seconds of chat/speech looked at to work out the activity
+POLL_INTERVAL = 1.0  # how often a waiting loop re-checks the activity, so a burst of chat shortens the wait
+TICK_DEADLINE = 20.0  # a tick that hasn't started speaking after this many seconds is cancelled, its reply would be stale
+LLM_WORKERS = 2  # generations allowed at the same time across every channel
+
+# called with the channel id, builds the prompt and generates/sends the reply for that channel
+TickFunc = Callable[[str], Awaitable[None]]
+# called with the channel id and the window in seconds, returns how active the channel is in messages per minute
+ActivityFunc = Callable[[str, float], float]
+
+# the deadline of the tick running in the current task, see lift_deadline
+_tick_deadline: contextvars.ContextVar[asyncio.Timeout | None] = contextvars.ContextVar("tick_deadline", default=None)
+
+
+def lift_deadline() -> None:
+    # called from a tick once part of its reply has gone out (e.g. to tts), from then on it runs to the end rather
+    # than being cut off halfway through. A post that ends up late is dropped by the send queue's ttl instead
+    timeout = _tick_deadline.get()
+    if timeout is not None:
+        timeout.reschedule(None)
+
+
+def adaptive_interval(base: float, activity: float, *, reference: float = REFERENCE_ACTIVITY,
+                      minimum: float = MIN_INTERVAL, maximum: float = MAX_INTERVAL) -> float:
+    # twice the reference activity halves the wait, half of it doubles the wait, clamped to [minimum, maximum]
+    if activity <= 0:
+        return maximum
+    return min(maximum, max(minimum, base * reference / activity))
+
+
+class ChannelAiScheduler:
+    """
+    The ai loop for one channel.
+    Waits until its (activity adjusted) interval has passed, takes an llm worker, runs the tick, repeat.
+    - a channel never has more than one generation in flight, the next wait only starts once the tick is done
+    - if every llm worker is busy when the tick is due it is skipped rather than queued behind them
+    - a tick running past TICK_DEADLINE is cancelled, so a slow model can't post stale replies,
+      unless it has already started its reply (see lift_deadline)
+    """
+
+    def __init__(self, channel_id: str, tick: TickFunc, workers: asyncio.Semaphore, *,
+                 interval: float = DEFAULT_INTERVAL, activity: ActivityFunc | None = None,
+                 deadline: float | None = TICK_DEADLINE) -> None:
+        self.channel_id = channel_id
+        self.tick = tick
+        self.workers = workers
+        self.interval = interval
+        self.activity = activity
+        self.deadline = deadline
+        self.enabled = True
+        self._task: asyncio.Task | None = None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name=f"AiScheduler-{self.channel_id}")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def current_interval(self) -> float:
+        if self.activity is None:
+            return self.interval
+        try:
+            activity = self.activity(self.channel_id, ACTIVITY_WINDOW)
+        except Exception as e:
+            LOGGER.error("Activity check failed for channel %s: %r", self.channel_id, e)
+            return self.interval
+        return adaptive_interval(self.interval, activity)
+
+    async def _wait_until_due(self) -> None:
+        # re-evaluated every POLL_INTERVAL, chat picking up mid-wait brings the next message forward
+        waited_since = time.monotonic()
+        while True:
+            interval = self.current_interval()
+            metrics.AI_INTERVAL_SECONDS.labels(channel=self.channel_id).set(interval)
+            remaining = interval - (time.monotonic() - waited_since)
+            if remaining <= 0:
+                return
+            await asyncio.sleep(min(remaining, POLL_INTERVAL))
+
+    async def _run(self) -> None:
+        while True:
+            await self._wait_until_due()
+            if not self.enabled:
+                continue
+            if self.workers.locked():
+                # the other channels have every worker, waiting would only make this reply late
+                metrics.AI_TICKS.labels(result="skipped_busy").inc()
+                LOGGER.debug("Skipped ai tick for channel %s, every llm worker is busy", self.channel_id)
+                continue
+            async with self.workers:
+                try:
+                    async with asyncio.timeout(self.deadline) as deadline:
+                        token = _tick_deadline.set(deadline)
+                        try:
+                            await self.tick(self.channel_id)
+                        finally:
+                            _tick_deadline.reset(token)
+                except TimeoutError:
+                    metrics.AI_TICKS.labels(result="deadline").inc()
+                    LOGGER.warning("AI tick for channel %s ran past %.0fs and was dropped", self.channel_id,
+                                   self.deadline)
+                    continue
+                except Exception as e:
+                    metrics.AI_TICKS.labels(result="failed").inc()
+                    LOGGER.error("AI tick failed for channel %s: %r", self.channel_id, e)
+                    continue
+            metrics.AI_TICKS.labels(result="ran").inc()
+
+
+class AiScheduler:
+    """
+    Keeps a ChannelAiScheduler for every channel the bot talks in.
+    - .add_channel(channel_id) starts one (no-op if it exists)
+    - .stop() stops them all
+    """
+
+    def __init__(self, tick: TickFunc, *, workers: int = LLM_WORKERS,
+                 intervals: dict[str, float] | None = None, activity: ActivityFunc | None = None,
+                 deadline: float | None = TICK_DEADLINE) -> None:
+        self.tick = tick
+        self.workers = asyncio.Semaphore(workers)
+        self.intervals = intervals or {}
+        self.activity = activity
+        self.deadline = deadline
+        self.channels: dict[str, ChannelAiScheduler] = {}
+
+    def add_channel(self, channel_id: str) -> ChannelAiScheduler:
+        channel_id = str(channel_id)
+        scheduler = self.channels.get(channel_id)
+        if scheduler is None:
+            interval = self.intervals.get(channel_id, DEFAULT_INTERVAL)
+            scheduler = self.channels[channel_id] = ChannelAiScheduler(channel_id, self.tick, self.workers,
+                                                                       interval=interval, activity=self.activity,
+                                                                       deadline=self.deadline)
+            scheduler.start()
+            LOGGER.info("Started ai scheduling for channel %s every %.0fs", channel_id, interval)
+        return scheduler
+
+    async def stop(self) -> None:
+        await asyncio.gather(*(scheduler.stop() for scheduler in self.channels.values()))
+        self.channels.clear()
@@ -1 +1,189 @@
-# this file will contain information for training the ai based on messages db
\ No newline at end of file
+# this file exports the collected chat messages as training data for tuning the ai's persona
+# usage: python ai_train.py [training_data.jsonl] [--db messages.db] [--users excluded_users.db]
+# every line of the output is one conversation window:
+#   {"channel_id": "...", "start": "2025-01-01 12:00:00", "messages": [[0, "first line"], [1, "a reply"], ...]}
+# the number before each line is the speaker within that window, so turns are kept without storing who said it
+import argparse
+import asyncio
+import collections
+import datetime
+import gzip
+import json
+import logging
+import os
+import pathlib
+import re
+import sqlite3
+import time
+from collections.abc import Iterator
+
+import storage
+from chat_download_formatter import load_optouts
+
+LOGGER: logging.Logger = logging.getLogger("TrainExport")
+
+### OPTIONS ###
+OUTPUT_FILE = "training_data.jsonl"  # a name ending in .gz is written gzip compressed
+FETCH_SIZE = 5000  # rows pulled from the cursor at a time, memory use doesn't grow with the size of the db
+INCLUDE_ARCHIVE = True  # also export messages that retention pruning moved into messages_archive
+SKIP_PREFIX = "!"  # messages starting with this are bot commands, not chat. None keeps them
+WINDOW_MESSAGES = 20  # most messages in one conversation window
+WINDOW_GAP_SECONDS = 300  # chat going quiet for longer than this starts a new window
+MIN_WINDOW_MESSAGES = 2  # windows shorter than this aren't a conversation and are left out
+DEDUPE_WINDOW = 500  # a message is spam if its normalised text matches one of the last this many different ones
+PROGRESS_EVERY = 1_000_000  # rows between progress logs
+
+_NOT_WORDS = re.compile(r"[\W_]+")
+_STRETCHED = re.compile(r"(.)\1\1+")  # three or more of the same character
+
+
+def spam_key(text: str) -> str:
+    # near-identical messages map to the same key: case, punctuation, stretched letters ("noooooo") and
+    # repeated words ("pog pog pog") don't count
+    text = _NOT_WORDS.sub(" ", text.casefold())
+    if _STRETCHED.search(text):
+        text = _STRETCHED.sub(r"\1", text)
+    return " ".join(dict.fromkeys(text.split()))
+
+
+def _parse_time(value: str | None) -> datetime.datetime | None:
+    try:
+        return datetime.datetime.fromisoformat(value) if value else None
+    except ValueError:
+        return None
+
+
+def load_excluded(connection: sqlite3.Connection, user_db: str) -> set[str]:
+    # opted out users (ids and, for imported logs, names) plus ignored accounts and anyone with a purge still running
+    excluded = asyncio.run(load_optouts(user_db))
+    excluded.update(str(user_id) for user_id in storage.IGNORED_USERS)
+    try:
+        rows = connection.execute("SELECT DISTINCT user_id FROM purge_jobs WHERE finished IS NULL").fetchall()
+    except sqlite3.OperationalError:
+        rows = []  # a db from before purges existed
+    excluded.update(str(row[0]).casefold() for row in rows)
+    return excluded
+
+
+def stream_rows(connection: sqlite3.Connection, table: str, fetch_size: int = FETCH_SIZE) -> Iterator[tuple]:
+    # (channel_id, user_id, message, time) grouped by channel, oldest first. sqlite steps through the
+    # (channel_id, time) index as rows are fetched, nothing is read ahead of the cursor
+    cursor = connection.execute(f"""SELECT channel_id, user_id, message, time
+                                    FROM {table}
+                                    ORDER BY channel_id, time""")
+    while rows := cursor.fetchmany(fetch_size):
+        yield from rows
+
+
+def build_windows(rows: Iterator[tuple], excluded: set[str], counts: dict[str, int], started: float) -> Iterator[dict]:
+    # only the current channel's window and recent spam keys are kept, so memory stays flat however many rows go by
+    window: list[list] = []
+    speakers: dict[str, int] = {}
+    recent: collections.OrderedDict[str, None] = collections.OrderedDict()
+    channel = start = last = None
+
+    def finish():
+        if len(window) >= MIN_WINDOW_MESSAGES:
+            counts["windows"] += 1
+            counts["exported"] += len(window)
+            result = {"channel_id": channel, "start": start, "messages": list(window)}
+        else:
+            counts["short"] += len(window)
+            result = None
+        window.clear()
+        speakers.clear()
+        return result
+
+    for channel_id, user_id, message, sent in rows:
+        counts["rows"] += 1
+        if counts["rows"] % PROGRESS_EVERY == 0:
+            elapsed = time.perf_counter() - started
+            LOGGER.info("%d rows read, %d exported (%d rows/s)", counts["rows"], counts["exported"],
+                        counts["rows"] / elapsed)
+        if user_id.casefold() in excluded:
+            counts["excluded"] += 1
+            continue
+        if SKIP_PREFIX and message.startswith(SKIP_PREFIX):
+            counts["commands"] += 1
+            continue
+        key = spam_key(message)
+        if not key:
+            counts["empty"] += 1  # emotes/punctuation only
+            continue
+
+        sent_at = _parse_time(sent)
+        if channel_id != channel:
+            if (done := finish()) is not None:
+                yield done
+            recent.clear()
+            channel = channel_id
+        elif sent_at is not None and last is not None and (sent_at - last).total_seconds() > WINDOW_GAP_SECONDS:
+            if (done := finish()) is not None:
+                yield done
+        last = sent_at or last
+
+        if key in recent:
+            counts["duplicates"] += 1
+            recent.move_to_end(key)
+            continue
+        recent[key] = None
+        if len(recent) > DEDUPE_WINDOW:
+            recent.popitem(last=False)
+
+        if not window:
+            start = sent
+        window.append([speakers.setdefault(user_id, len(speakers)), message])
+        if len(window) >= WINDOW_MESSAGES:
+            yield finish()
+    if (done := finish()) is not None:
+        yield done
+
+
+def _open_output(path: str):
+    if path.endswith(".gz"):
+        return gzip.open(path, "wt", encoding="utf-8", compresslevel=6)
+    return open(path, "w", encoding="utf-8", buffering=1024 * 1024)
+
+
+def export_training_data(output: str = OUTPUT_FILE, msg_db: str = storage.MESSAGE_DB,
+                         user_db: str = storage.USER_DB, *, include_archive: bool = INCLUDE_ARCHIVE) -> dict[str, float]:
+    # one pass over the message db, which is opened read only so this can run while the bot is collecting
+    started = time.perf_counter()
+    counts = collections.Counter()
+    connection = sqlite3.connect(pathlib.Path(msg_db).resolve().as_uri() + "?mode=ro", uri=True)
+    try:
+        connection.execute(f"PRAGMA mmap_size = {storage.MMAP_SIZE}")
+        connection.execute(f"PRAGMA cache_size = {-storage.CACHE_SIZE_KB}")
+        excluded = load_excluded(connection, user_db)
+        tables = ["messages", "messages_archive"] if include_archive else ["messages"]
+        existing = {row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        with _open_output(output) as out:
+            for table in tables:
+                if table not in existing:
+                    LOGGER.warning("No %s table in %s, skipped", table, msg_db)
+                    continue
+                for window in build_windows(stream_rows(connection, table), excluded, counts, started):
+                    out.write(json.dumps(window, ensure_ascii=False, separators=(",", ":")) + "\n")
+    finally:
+        connection.close()
+
+    elapsed = time.perf_counter() - started
+    counts["seconds"] = round(elapsed, 3)
+    counts["rows_per_second"] = round(counts["rows"] / elapsed) if elapsed else 0
+    counts["output_bytes"] = os.path.getsize(output)
+    LOGGER.info("Exported %d of %d messages as %d windows to %s in %.2fs (%d rows/s, %.1f MB), skipped %d excluded, "
+                "%d duplicates, %d commands, %d empty, %d in windows too short", counts["exported"], counts["rows"],
+                counts["windows"], output, elapsed, counts["rows_per_second"], counts["output_bytes"] / 1e6,
+                counts["excluded"], counts["duplicates"], counts["commands"], counts["empty"], counts["short"])
+    return dict(counts)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Export collected chat as conversation windows for training")
+    parser.add_argument("output", nargs="?", default=OUTPUT_FILE, help="jsonl file to write, .gz to compress")
+    parser.add_argument("--db", default=storage.MESSAGE_DB, help="message database")
+    parser.add_argument("--users", default=storage.USER_DB, help="opt-out database")
+    parser.add_argument("--no-archive", action="store_true", help="leave out messages_archive")
+    args = parser.parse_args()
+    export_training_data(args.output, args.db, args.users, include_archive=not args.no_archive)
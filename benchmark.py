@@ -0,0 +1,353 @@
+# this file contains offline benchmarks for the bot's hot paths
+# usage: python benchmark.py [--only messages ingest ...] [--sizes 10000 100000] [--out results.jsonl]
+# every result is one json object per line, so runs from different changes can be diffed or loaded with pandas
+import argparse
+import asyncio
+import contextlib
+import datetime
+import json
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import asqlite
+
+import message_store
+import storage
+from chat_context import ChatContextBuffer
+from message_ingest import MessageIngestQueue
+from optout_cache import OptOutCache
+
+### OPTIONS ###
+DEFAULT_SIZES = [10_000, 100_000, 1_000_000]  # message table sizes to test against
+REPEATS = 50  # times each query is run, the median is reported
+FIREHOSE_MESSAGES = 20_000  # synthetic chat messages pushed through ingest
+TTS_SENTENCE = "Chat is absolutely cooked right now, and I am not even sorry about it."
+TTS_REPEATS = 3
+LLM_REPEATS = 20
+# the w<n> words are rare in the synthetic chat, like a name or a specific topic would be in real chat
+SEARCH_TEXT = "the boss fight in this dungeon is impossible w1234 w56789, chat says the sword build is broken w4242"
+# synthetic chat is drawn from this with a zipf-ish skew, so the full-text index sees common and rare words
+CHAT_WORDS = ("lol pog gg chat boss fight dungeon sword build broken nerf buff stream music song map game level "
+              "circle bee wellington cat dog raid clip emote sub follow mod ban lag fps pc console speedrun "
+              "glitch skip cutscene lore theory ending secret item drop rare legendary shield potion").split()
+
+
+def _median_ms(func, repeats: int = REPEATS) -> float:
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return timings[len(timings) // 2]
+
+
+def _percentiles_ms(timings: list[float]) -> dict[str, float]:
+    timings = sorted(timings)
+    pick = lambda q: round(timings[min(len(timings) - 1, int(q * len(timings)))] * 1000, 4)
+    return {"p50_ms": pick(0.5), "p95_ms": pick(0.95), "max_ms": round(timings[-1] * 1000, 4)}
+
+
+def _fill_messages(conn: sqlite3.Connection, rows: int, users: int = 5000) -> None:
+    # spreads messages over the last year so time based queries have something to filter
+    now = datetime.datetime.now(datetime.timezone.utc)
+    start = now - datetime.timedelta(days=365)
+    step = datetime.timedelta(days=365) / rows
+
+    weights = [1 / (rank + 1) for rank in range(len(CHAT_WORDS))]
+
+    def generate():
+        for i in range(rows):
+            stamp = (start + step * i).strftime("%Y-%m-%d %H:%M:%S")
+            words = random.choices(CHAT_WORDS, weights, k=random.randint(2, 8))
+            yield str(i), str(random.randrange(users)), " ".join(words) + f" w{random.randrange(rows)}", stamp
+
+    conn.execute(message_store.MESSAGES_SCHEMA)
+    conn.execute(message_store.ARCHIVE_SCHEMA)
+    with conn:
+        conn.executemany("INSERT INTO messages(message_id, user_id, message, time) VALUES (?, ?, ?, ?)", generate())
+
+
+def bench_message_queries(rows: int) -> list[dict]:
+    # times the prompt query and the ban delete, before and after the indexes are added
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        conn = sqlite3.connect(os.path.join(tmp, "messages.db"))
+        _fill_messages(conn, rows)
+        cutoff = (datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(minutes=30)).strftime(
+            "%Y-%m-%d %H:%M:%S")
+
+        def newest():
+            conn.execute("SELECT * FROM messages ORDER BY time DESC LIMIT 5").fetchall()
+
+        def ban_delete():
+            # same WHERE clause as event_ban, rolled back so every run sees the same table
+            conn.execute("BEGIN")
+            conn.execute("DELETE FROM messages WHERE user_id = ? AND time >= ?", ("42", cutoff))
+            conn.execute("ROLLBACK")
+
+        conn.isolation_level = None
+        for indexed in (False, True):
+            if indexed:
+                for index in message_store.MESSAGES_INDEXES:
+                    conn.execute(index)
+                conn.execute("ANALYZE")
+            for name, func in (("newest_5", newest), ("ban_delete", ban_delete)):
+                results.append({"bench": "messages." + name, "rows": rows, "indexed": indexed,
+                                "median_ms": round(_median_ms(func), 4)})
+        conn.close()
+    return results
+
+
+async def _bench_search(path: str, rows: int) -> list[dict]:
+    async with asqlite.create_pool(path) as db:
+        start = time.perf_counter()
+        await storage.migrate_messages(db)  # builds the full-text index over what _fill_messages wrote
+        build_seconds = time.perf_counter() - start
+        timings = []
+        for _ in range(REPEATS):
+            start = time.perf_counter()
+            await message_store.search_related(db, SEARCH_TEXT)
+            timings.append(time.perf_counter() - start)
+    return [{"bench": "messages.fts_search", "rows": rows, "index_build_s": round(build_seconds, 2),
+             **_percentiles_ms(timings)}]
+
+
+def bench_search(rows: int) -> list[dict]:
+    # top-K relevance search that ai_talk runs every tick, includes the vocab lookup for rare words
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "messages.db")
+        conn = sqlite3.connect(path)
+        _fill_messages(conn, rows)
+        conn.close()
+        return asyncio.run(_bench_search(path, rows))
+
+
+def bench_prompt_context(rows: int) -> list[dict]:
+    # ai_talk builds its prompt from the in-memory context buffer, this shows it doesn't care how big the db is
+    context = ChatContextBuffer()
+    for i in range(min(rows, context.size)):
+        context.add("channel", str(i), str(i % 50), f"synthetic chat message {i}")
+
+    def build():
+        "\n".join(message.text for message in context.recent("channel"))
+
+    return [{"bench": "prompt.context_buffer", "rows": rows, "median_ms": round(_median_ms(build), 4)}]
+
+
+async def _ingest_runs(db: asqlite.Pool, firehose: list[tuple[str, str, str]], optouts: OptOutCache,
+                       pragmas: str) -> list[dict]:
+    results = []
+    messages = len(firehose)
+
+    # the old path, one INSERT per message
+    start = time.perf_counter()
+    async with db.acquire() as connection:
+        for message_id, user_id, message in firehose[:messages // 10]:
+            await connection.execute("""INSERT INTO messages(message_id, user_id, message)
+                                        VALUES (?, ?, ?)""", ("single-" + message_id, user_id, message))
+    elapsed = time.perf_counter() - start
+    results.append({"bench": "ingest.single_insert", "pragmas": pragmas, "messages": messages // 10,
+                    "messages_per_second": round(messages // 10 / elapsed)})
+
+    # opt-out check + write-behind queue, flushed at the end so the time covers the db writes too
+    queue = MessageIngestQueue(db)
+    queue.start()
+    start = time.perf_counter()
+    for message_id, user_id, message in firehose:
+        if user_id not in optouts:
+            queue.put(message_id, user_id, message)
+        # give the flush task a turn now and then, like the event loop would between messages
+        if queue.pending_count() >= queue.batch_size:
+            await asyncio.sleep(0)
+    await queue.stop()
+    elapsed = time.perf_counter() - start
+    results.append({"bench": "ingest.write_behind", "pragmas": pragmas, "messages": messages,
+                    "messages_per_second": round(messages / elapsed)})
+    return results
+
+
+async def _bench_ingest(messages: int) -> list[dict]:
+    results = []
+    optouts = OptOutCache([100135110, 161325782])
+    for user_id in range(0, 5000, 10):
+        optouts.add(str(user_id))
+    firehose = [(f"msg-{i}", str(random.randrange(5000)), f"synthetic chat message {i}") for i in range(messages)]
+
+    # opt-out check alone, this runs for every single chat line
+    start = time.perf_counter()
+    for _, user_id, _ in firehose:
+        _ = user_id in optouts
+    elapsed = time.perf_counter() - start
+    results.append({"bench": "ingest.optout_check", "messages": messages,
+                    "ns_per_check": round(elapsed / messages * 1e9, 1)})
+
+    # asqlite's defaults (WAL, full sync, 10 connections) against the pragmas and pool the bot runs with
+    for pragmas in ("default", "tuned"):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "messages.db")
+            if pragmas == "tuned":
+                db = await storage.open_database(path, storage.message_migrations(), size=storage.MESSAGE_POOL_SIZE,
+                                                 mmap_size=storage.MMAP_SIZE)
+            else:
+                db = await asqlite.create_pool(path)
+                await storage.migrate_messages(db)
+            async with db:
+                results += await _ingest_runs(db, firehose, optouts, pragmas)
+    return results
+
+
+def bench_ingest(messages: int = FIREHOSE_MESSAGES) -> list[dict]:
+    return asyncio.run(_bench_ingest(messages))
+
+
+def bench_tts(repeats: int = TTS_REPEATS) -> list[dict]:
+    # synthesis only (no playback), real time factor above 1 means faster than it takes to say it
+    try:
+        import custom_tts
+    except ImportError as e:
+        return [{"bench": "tts.synthesis", "skipped": repr(e)}]
+    worker = custom_tts.TTSWorker(models_dir="tts_voice_files", preload=[])
+    results = []
+    for voice in custom_tts.Voice:
+        try:
+            model = worker._get_voice(voice)
+            for _ in model.synthesize("Warm up."):
+                pass
+        except Exception as e:
+            results.append({"bench": "tts.synthesis", "voice": voice.name, "skipped": repr(e)})
+            continue
+        timings = []
+        audio_seconds = 0.0
+        for _ in range(repeats):
+            start = time.perf_counter()
+            for chunk in model.synthesize(TTS_SENTENCE):
+                audio_seconds += len(chunk.audio_int16_bytes) / (chunk.sample_rate * chunk.sample_width *
+                                                                 chunk.sample_channels)
+            timings.append(time.perf_counter() - start)
+        results.append({"bench": "tts.synthesis", "voice": voice.name, **_percentiles_ms(timings),
+                        "real_time_factor": round(audio_seconds / sum(timings), 2)})
+    return results
+
+
+class _StubOllama(BaseHTTPRequestHandler):
+    # answers /api/chat and /api/generate like ollama would, with a fixed reply and no model behind it
+    REPLY = "Nice try chat. Circles are still banned in here, no exceptions."
+
+    def do_POST(self) -> None:
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        base = {"model": body.get("model", "stub"), "created_at": "2024-01-01T00:00:00Z"}
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+        if self.path == "/api/generate":
+            self.wfile.write(json.dumps({**base, "response": "", "done": True}).encode() + b"\n")
+        elif body.get("stream", True):
+            for word in self.REPLY.split(" "):
+                part = {**base, "message": {"role": "assistant", "content": word + " "}, "done": False}
+                self.wfile.write(json.dumps(part).encode() + b"\n")
+            self.wfile.write(json.dumps({**base, "message": {"role": "assistant", "content": ""},
+                                         "done": True}).encode() + b"\n")
+        else:
+            self.wfile.write(json.dumps({**base, "message": {"role": "assistant", "content": self.REPLY},
+                                         "done": True, "total_duration": 0, "load_duration": 0}).encode())
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+async def _bench_llm(repeats: int) -> list[dict]:
+    import ai_responses
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _StubOllama)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    ai_responses.OLLAMA_HOST = f"http://127.0.0.1:{server.server_address[1]}"
+    ai_responses._client = None
+    results = []
+    try:
+        await ai_responses.response_initial("warm up", "")
+        timings = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            await ai_responses.response_initial("Do you like cats @mrivory124_alt?", "I cannot believe this chat")
+            timings.append(time.perf_counter() - start)
+        results.append({"bench": "llm.response_initial", "repeats": repeats, **_percentiles_ms(timings)})
+
+        timings = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            # closed on the way out of the with, leaving the generator for gc makes it close on a dead loop
+            async with contextlib.aclosing(ai_responses.response_stream("Do you like cats @mrivory124_alt?", "")) as stream:
+                async for _ in stream:
+                    timings.append(time.perf_counter() - start)
+                    break
+        results.append({"bench": "llm.first_sentence", "repeats": repeats, **_percentiles_ms(timings)})
+    finally:
+        server.shutdown()
+        ai_responses._client = None
+    return results
+
+
+def bench_llm(repeats: int = LLM_REPEATS) -> list[dict]:
+    # client overhead against a local stub, so it measures our side of the round trip and not the model
+    try:
+        return asyncio.run(_bench_llm(repeats))
+    except ImportError as e:
+        return [{"bench": "llm.response_initial", "skipped": repr(e)}]
+
+
+def run_metadata() -> dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                timeout=5).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        commit = ""
+    return {"bench": "meta", "commit": commit, "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version, "machine": platform.machine(),
+            "time": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds")}
+
+
+BENCHES = ["messages", "prompt", "ingest", "tts", "llm"]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Offline benchmarks for the bot's hot paths")
+    parser.add_argument("--only", nargs="+", choices=BENCHES, default=BENCHES)
+    parser.add_argument("--sizes", nargs="+", type=int, default=DEFAULT_SIZES, help="message table sizes")
+    parser.add_argument("--out", help="also append results to this jsonl file")
+    args = parser.parse_args()
+
+    out = open(args.out, "a", encoding="utf-8") if args.out else None
+
+    def emit(result: dict) -> None:
+        line = json.dumps(result)
+        print(line)
+        if out is not None:
+            out.write(line + "\n")
+
+    emit(run_metadata())
+    for size in args.sizes:
+        if "messages" in args.only:
+            for result in bench_message_queries(size):
+                emit(result)
+            for result in bench_search(size):
+                emit(result)
+        if "prompt" in args.only:
+            for result in bench_prompt_context(size):
+                emit(result)
+    if "ingest" in args.only:
+        for result in bench_ingest():
+            emit(result)
+    if "tts" in args.only:
+        for result in bench_tts():
+            emit(result)
+    if "llm" in args.only:
+        for result in bench_llm():
+            emit(result)
+    if out is not None:
+        out.close()
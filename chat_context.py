@@ -0,0 +1,85 @@
+# this file keeps the most recent chat messages in memory so prompts can be built without reading the db
+import time
+from collections import deque
+from dataclasses import dataclass
+
+### OPTIONS ###
+CONTEXT_BUFFER_SIZE = 200  # messages kept per channel, the window below is taken from these
+CONTEXT_WINDOW_MESSAGES = 5  # how many recent messages go into a prompt, None for no count limit
+CONTEXT_WINDOW_SECONDS = None  # only use messages newer than this, None for no age limit
+
+
+@dataclass(slots=True)
+class ContextMessage:
+    message_id: str
+    user_id: str
+    text: str
+    received: float  # time.monotonic() when it arrived
+
+
+class ChatContextBuffer:
+    """
+    Bounded ring buffer of recent chat messages, one per channel.
+    - event_message calls .add() for every message that would be stored
+    - deletes, bans and opt-outs call .remove_message() / .remove_user()
+    - .recent(channel_id) returns the prompt window, newest first
+    """
+
+    def __init__(self, *, size: int = CONTEXT_BUFFER_SIZE, window_messages: int | None = CONTEXT_WINDOW_MESSAGES,
+                 window_seconds: float | None = CONTEXT_WINDOW_SECONDS) -> None:
+        self.size = size
+        self.window_messages = window_messages
+        self.window_seconds = window_seconds
+        self._channels: dict[str, deque[ContextMessage]] = {}
+
+    def _channel(self, channel_id: str) -> deque[ContextMessage]:
+        channel = self._channels.get(str(channel_id))
+        if channel is None:
+            channel = self._channels[str(channel_id)] = deque(maxlen=self.size)
+        return channel
+
+    def add(self, channel_id: str, message_id: str, user_id: str, text: str, *, age: float = 0.0) -> None:
+        # age is how many seconds ago the message was sent, only needed when seeding from the db
+        received = time.monotonic() - age
+        self._channel(channel_id).append(ContextMessage(message_id, str(user_id), text, received))
+
+    def remove_message(self, message_id: str) -> None:
+        for channel in self._channels.values():
+            for message in channel:
+                if message.message_id == message_id:
+                    channel.remove(message)
+                    return
+
+    def remove_user(self, user_id: str) -> None:
+        user_id = str(user_id)
+        for channel_id, channel in self._channels.items():
+            if any(message.user_id == user_id for message in channel):
+                self._channels[channel_id] = deque((m for m in channel if m.user_id != user_id), maxlen=self.size)
+
+    def rate(self, channel_id: str, seconds: float) -> float:
+        # messages per minute over the last `seconds`, used by the ai scheduler to tell busy chat from quiet
+        channel = self._channels.get(str(channel_id))
+        if not channel or seconds <= 0:
+            return 0.0
+        oldest_allowed = time.monotonic() - seconds
+        count = 0
+        for message in reversed(channel):
+            if message.received < oldest_allowed:
+                break
+            count += 1
+        return count * 60 / seconds
+
+    def recent(self, channel_id: str) -> list[ContextMessage]:
+        # newest first, same order the old "ORDER BY time DESC" query gave
+        channel = self._channels.get(str(channel_id))
+        if not channel:
+            return []
+        oldest_allowed = None if self.window_seconds is None else time.monotonic() - self.window_seconds
+        window = []
+        for message in reversed(channel):
+            if self.window_messages is not None and len(window) >= self.window_messages:
+                break
+            if oldest_allowed is not None and message.received < oldest_allowed:
+                break
+            window.append(message)
+        return window
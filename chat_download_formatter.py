@@ -1,43 +1,181 @@
-# this file exists for fomatting downloaded chat logs in txt form to the database
+# this file exists for importing downloaded chat logs in txt form into the message database
+# usage: python chat_download_formatter.py [Chat.txt] [messages.db] --channel channel-id [--started time] [--source vod-id]
+import argparse
 import asyncio
+import datetime
+import hashlib
+import itertools
+import logging
+import os
+import sqlite3
 import sys
+import time
 
 import asqlite
 
-global id_msg
+import storage
+from message_ingest import utc_timestamp
 
-async def create_db():
-    async with asqlite.create_pool("temp_msg.db") as db:
+LOGGER: logging.Logger = logging.getLogger("ChatImport")
+
+### OPTIONS ###
+# one message per line, "user|message" or "time|user|message". time is a utc timestamp ("2025-01-01 12:00:00"),
+# or with --started, how far into the stream it was sent ("1:02:03")
+CHAT_FILE = "Chat.txt"
+MESSAGE_DB = storage.MESSAGE_DB
+USER_DB = storage.USER_DB
+IMPORT_BATCH_SIZE = 50_000  # lines per transaction
+IMPORT_CACHE_SIZE_KB = 200_000  # bigger page cache than the bot uses, keeps the indexes in memory for a long import
+
+
+def file_source_id(chat_file: str) -> str:
+    # every download is called Chat.txt, so logs are told apart by their content rather than their name
+    digest = hashlib.sha256()
+    with open(chat_file, "rb") as chat:
+        while block := chat.read(1024 * 1024):
+            digest.update(block)
+    return digest.hexdigest()[:16]
+
+
+def needs_bot_migration(msg_db: str) -> bool:
+    # a message db from before schema versioning has messages without a channel, only the bot knows which channel
+    # they came from (its owner's), so it has to be the one to migrate it
+    if not os.path.exists(msg_db):
+        return False
+    conn = sqlite3.connect(msg_db)
+    try:
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        has_messages = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'messages'").fetchone() is not None
+    finally:
+        conn.close()
+    return version == 0 and has_messages
+
+
+async def load_optouts(user_db: str) -> set[str]:
+    # logs only have usernames, so both ids and names are matched (case insensitive)
+    if not os.path.exists(user_db):
+        return set()
+    async with asqlite.connect(user_db) as conn:
+        rows = await conn.fetchall("""SELECT user_id, username
+                                      FROM excluded_users""")
+    excluded = set()
+    for row in rows:
+        excluded.add(str(row["user_id"]).casefold())
+        if row["username"]:
+            excluded.add(row["username"].casefold())
+    return excluded
+
+
+def parse_time(value: str, started: datetime.datetime | None = None) -> str | None:
+    # the stored form of a log timestamp (same format as sqlite's CURRENT_TIMESTAMP), None if it isn't one
+    value = value.strip()
+    try:
+        sent = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        parts = value.split(":")
+        if started is None or not 1 <= len(parts) <= 3 or not all(part.isdigit() for part in parts):
+            return None
+        seconds = 0
+        for part in parts:
+            seconds = seconds * 60 + int(part)
+        sent = started + datetime.timedelta(seconds=seconds)
+    if sent.tzinfo is not None:
+        sent = sent.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return sent.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def parse_lines(lines, first_line_no: int, source: str, excluded: set[str], counts: dict[str, int], *,
+                channel_id: str | None = None, started: datetime.datetime | None = None, imported_at: str = ""):
+    # yields (message_id, user_id, message, time, channel_id) rows, counting anything that gets skipped
+    # lines without a timestamp get imported_at, the bot doesn't seed its chat context with imported messages so
+    # they aren't mistaken for live chat
+    for line_no, line in enumerate(lines, start=first_line_no):
+        line = line.rstrip("\r\n")
+        fields = line.split("|", 2)
+        # a username is never a timestamp, so a message containing | can't be mistaken for a timed line
+        sent = parse_time(fields[0], started) if len(fields) == 3 else None
+        if sent is not None:
+            user, sep, message = fields[1], "|", fields[2]
+        else:
+            user, sep, message = line.partition("|")
+        user, message = user.strip(), message.strip()
+        if not sep or not user or not message:
+            counts["malformed"] += 1
+            continue
+        if user.casefold() in excluded:
+            counts["opted_out"] += 1
+            continue
+        if sent is None:
+            sent = imported_at
+            counts["untimed"] += 1
+        # the same log and line always gets the same id, so importing a log twice doesn't duplicate it
+        #TODO make this translate the users name into their real id
+        yield f"import:{source}:{line_no}", user, message, sent, channel_id
+
+
+async def import_chat_log(chat_file: str = CHAT_FILE, msg_db: str = MESSAGE_DB,
+                          user_db: str = USER_DB, batch_size: int = IMPORT_BATCH_SIZE, *,
+                          channel_id: str | None = None, started: datetime.datetime | None = None,
+                          source: str | None = None) -> dict[str, float]:
+    # channel_id is the channel the log is from, without it the messages never show up in any channel's prompts
+    # started is when the stream began, for logs timed relative to it
+    # source goes into every message id, by default it is a hash of the log so two logs never collide
+    if needs_bot_migration(msg_db):
+        raise RuntimeError(f"{msg_db} is from an older version of the bot, start the bot once to upgrade it "
+                           f"before importing")
+    start = time.perf_counter()
+    excluded = await load_optouts(user_db)
+    counts = {"lines": 0, "imported": 0, "duplicates": 0, "malformed": 0, "opted_out": 0, "untimed": 0}
+    source = source or file_source_id(chat_file)
+    if channel_id is None:
+        LOGGER.warning("No channel given, imported messages won't be used in any channel's prompts")
+    imported_at = utc_timestamp()
+
+    async with await storage.open_database(msg_db, storage.message_migrations(), size=1,
+                                           cache_size_kb=IMPORT_CACHE_SIZE_KB) as db:
+        # one connection and one transaction per batch for the whole import
         async with db.acquire() as conn:
-            await conn.execute("""CREATE TABLE IF NOT EXISTS temp_msg
-                                  (
-                                      message_id TEXT PRIMARY KEY,
-                                      user_id TEXT NOT NULL,
-                                      message TEXT NOT NULL,
-                                      time TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                                  )""")
-
-async def insert_db(line_split):
-    global id_msg
-    async with asqlite.create_pool("temp_msg.db") as db:
-        async with db.acquire() as connection:
-            #TODO make this translate the users id into their real id
-            await connection.execute("""INSERT INTO temp_msg(message_id, user_id, message)
-                                        VALUES (?, ?, ?)""", (str(id_msg), line_split[0], line_split[1]))
-
-async def main():
-    global id_msg
-    id_msg = 0
-    await create_db()
-    with open('Chat.txt', "r", encoding='utf-8') as topo_file:
-        for line in topo_file:
-            split_line = line.split("|")
-            try:
-                print(split_line[0])
-            except:
-                print("error on line:" + line)
-            id_msg = id_msg + 1
-            await insert_db(line_split=split_line)
+            with open(chat_file, "r", encoding="utf-8") as chat:
+                while True:
+                    lines = list(itertools.islice(chat, batch_size))
+                    if not lines:
+                        break
+                    rows = list(parse_lines(lines, counts["lines"] + 1, source, excluded, counts,
+                                            channel_id=channel_id, started=started, imported_at=imported_at))
+                    counts["lines"] += len(lines)
+                    if not rows:
+                        continue
+                    async with conn.transaction():
+                        cursor = await conn.executemany("""INSERT OR IGNORE INTO messages(message_id, user_id, message, time, channel_id)
+                                                           VALUES (?, ?, ?, ?, ?)""", rows)
+                    inserted = cursor.get_cursor().rowcount
+                    counts["imported"] += inserted
+                    counts["duplicates"] += len(rows) - inserted
+
+    elapsed = time.perf_counter() - start
+    counts["seconds"] = round(elapsed, 3)
+    counts["lines_per_second"] = round(counts["lines"] / elapsed) if elapsed else 0
+    LOGGER.info("Imported %d of %d lines from %s in %.2fs (%d lines/s), skipped %d malformed, %d opted out, "
+                "%d already imported", counts["imported"], counts["lines"], chat_file, elapsed,
+                counts["lines_per_second"], counts["malformed"], counts["opted_out"], counts["duplicates"])
+    if counts["untimed"]:
+        LOGGER.warning("%d lines had no timestamp and were stored with the import time", counts["untimed"])
+    return counts
+
 
 if __name__ == '__main__':
-    asyncio.run(main())
\ No newline at end of file
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Import a downloaded chat log into the message database")
+    parser.add_argument("chat_file", nargs="?", default=CHAT_FILE)
+    parser.add_argument("msg_db", nargs="?", default=MESSAGE_DB)
+    parser.add_argument("--channel", required=True, help="id of the channel the log is from")
+    parser.add_argument("--started", type=datetime.datetime.fromisoformat,
+                        help="utc time the stream started, for logs timed from the start of the stream")
+    parser.add_argument("--source", help="id for this log (e.g. the vod id), defaults to a hash of its content")
+    args = parser.parse_args()
+    try:
+        asyncio.run(import_chat_log(args.chat_file, args.msg_db, channel_id=args.channel, started=args.started,
+                                    source=args.source))
+    except RuntimeError as e:
+        LOGGER.error("%s", e)
+        sys.exit(1)
@@ -1,46 +1,255 @@
 #!/usr/bin/env python3
 
 # NOTE: this example requires PyAudio because it uses the Microphone class
+import collections
+import logging
+import math
+import queue
+import threading
 import time
+from dataclasses import dataclass
 
+import numpy as np
 import speech_recognition as sr
 
-global words
-words = ""
-global stop_listening
+import metrics
 
-# this is called from the background thread
-def callback(recognizer, audio):
-    global words
-    # received audio data, now we'll recognize it using Whisper from openai
+### OPTIONS ###
+TRANSCRIPT_SECONDS = 600  # recognised segments older than this are dropped
+MAX_TRANSCRIPT_SEGMENTS = 500  # hard cap on stored segments, so it can't grow while ai_talk is toggled off
+LISTEN_TIMEOUT = 1  # seconds, how often the capture thread checks whether it should stop
+PHRASE_TIME_LIMIT = None  # cap on a single phrase, None lets the recogniser decide
+WHISPER_MODEL = "base"  # loaded once per transcription worker
+WHISPER_WORKERS = 1  # transcription threads, each holds its own model (torch releases the GIL while it runs)
+MAX_PENDING_SEGMENTS = 32  # phrases waiting for whisper, the oldest is dropped when full so capture never waits
+# energy gate, phrases that don't pass are never sent to whisper
+ENERGY_THRESHOLD = 300  # rms a 30ms frame needs to count as speech, same scale as sr.Recognizer.energy_threshold
+MIN_SPEECH_RATIO = 0.1  # share of frames that have to be speech
+MIN_SPEECH_SECONDS = 0.3  # phrases with less speech than this are skipped
+
+LOG = logging.getLogger("SpeechRecognition")
+
+@dataclass(frozen=True, slots=True)
+class TranscriptSegment:
+    index: int  # increases by one per segment and never resets, used as the read cursor
+    heard_at: float  # time.time() when whisper finished it
+    text: str
+    confidence: float  # 0-1, from whisper's average token log probability
+
+class TranscriptStore:
+    """
+    Bounded, lock protected transcript written by the whisper workers and read from the event loop.
+    - .append(text, confidence) from any thread
+    - .read_after(cursor) returns the new segments and the cursor to pass next time,
+      only the new segments are copied
+    - old segments fall off by count (max_segments) and age (max_age)
+    """
+
+    def __init__(self, *, max_segments: int = MAX_TRANSCRIPT_SEGMENTS, max_age: float = TRANSCRIPT_SECONDS) -> None:
+        self.max_age = max_age
+        self._segments: "collections.deque[TranscriptSegment]" = collections.deque(maxlen=max_segments)
+        self._next_index = 0
+        self._lock = threading.Lock()
+
+    def append(self, text: str, confidence: float = 1.0) -> TranscriptSegment:
+        now = time.time()
+        with self._lock:
+            segment = TranscriptSegment(self._next_index, now, text, confidence)
+            self._next_index += 1
+            self._segments.append(segment)
+            while self._segments and self._segments[0].heard_at < now - self.max_age:
+                self._segments.popleft()
+            return segment
+
+    @property
+    def cursor(self) -> int:
+        # index the next segment will get, reading from here only returns segments that arrive later
+        with self._lock:
+            return self._next_index
+
+    def read_after(self, cursor: int) -> tuple[list[TranscriptSegment], int]:
+        with self._lock:
+            new = []
+            # walk back from the newest so only the unread tail is touched
+            for segment in reversed(self._segments):
+                if segment.index < cursor:
+                    break
+                new.append(segment)
+            new.reverse()
+            return new, self._next_index
+
+    def between(self, since: float, until: float | None = None) -> list[TranscriptSegment]:
+        with self._lock:
+            return [segment for segment in self._segments
+                    if segment.heard_at > since and (until is None or segment.heard_at <= until)]
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._segments)
+
+# everything whisper has recognised, see TranscriptStore
+transcript = TranscriptStore()
+# set once the first whisper worker has its model loaded (or failed to), startup waits on it for its timing report
+whisper_ready = threading.Event()
+
+_capture_thread: threading.Thread | None = None
+_stop_event = threading.Event()
+_device_opens = 0  # how many times the microphone has been opened, should stay at 1
+_phrases = 0
+_started_at = 0.0
+
+# phrases that passed the gate, waiting for a whisper worker
+_segments: "queue.Queue[sr.AudioData | None]" = queue.Queue(maxsize=MAX_PENDING_SEGMENTS)
+_workers: list[threading.Thread] = []
+_metrics_lock = threading.Lock()
+_segments_skipped = 0  # rejected by the energy gate
+_segments_dropped = 0  # thrown away because whisper was too far behind
+_segments_transcribed = 0
+_inference_total = 0.0
+_inference_max = 0.0
+_inference_last = 0.0
+
+def is_speech(audio: sr.AudioData) -> bool:
+    # cheap energy based voice activity check, run on the capture thread before anything is queued
+    samples = np.frombuffer(audio.get_raw_data(convert_width=2), dtype=np.int16).astype(np.float32)
+    frame = max(1, int(audio.sample_rate * 0.03))
+    frames = len(samples) // frame
+    if frames == 0:
+        return False
+    rms = np.sqrt(np.mean(samples[:frames * frame].reshape(frames, frame) ** 2, axis=1))
+    speech_frames = int(np.count_nonzero(rms >= ENERGY_THRESHOLD))
+    return speech_frames / frames >= MIN_SPEECH_RATIO and speech_frames * 0.03 >= MIN_SPEECH_SECONDS
+
+def _queue_segment(audio: sr.AudioData) -> None:
+    global _segments_skipped, _segments_dropped
+    if not is_speech(audio):
+        with _metrics_lock:
+            _segments_skipped += 1
+        return
     try:
-        words_recognised = recognizer.recognize_whisper(audio, language="english")
-        print("Whisper thinks you said " + words_recognised)
-        words += words_recognised
-    except sr.UnknownValueError:
-        print("Whisper could not understand audio")
-    except sr.RequestError as e:
-        print(f"Could not request results from Whisper; {e}")
+        _segments.put_nowait(audio)
+    except queue.Full:
+        # whisper is behind, drop the oldest phrase rather than blocking capture
+        try:
+            _segments.get_nowait()
+            with _metrics_lock:
+                _segments_dropped += 1
+        except queue.Empty:
+            pass
+        _segments.put_nowait(audio)
 
-def start_listening() -> None:
+def _transcribe_worker() -> None:
+    # every worker loads whisper once and keeps it for the life of the thread
+    global _segments_transcribed, _inference_total, _inference_max, _inference_last
+    try:
+        import whisper  # pulls in torch, so it's only imported once a worker actually starts
+        model = whisper.load_model(WHISPER_MODEL)
+    except Exception as e:
+        LOG.error("Could not load whisper %s: %r", WHISPER_MODEL, e)
+        return
+    finally:
+        whisper_ready.set()
+    LOG.info("Whisper %s loaded on %s", WHISPER_MODEL, threading.current_thread().name)
+    while True:
+        audio = _segments.get()
+        if audio is None:
+            break
+        start = time.perf_counter()
+        try:
+            # whisper wants 16kHz mono float32
+            samples = np.frombuffer(audio.get_raw_data(convert_rate=16000, convert_width=2), dtype=np.int16)
+            result = model.transcribe(samples.astype(np.float32) / 32768.0, language="en", fp16=False)
+        except Exception as e:
+            LOG.error("Whisper failed on a segment: %r", e)
+            continue
+        elapsed = time.perf_counter() - start
+        metrics.WHISPER_SECONDS.observe(elapsed)
+        with _metrics_lock:
+            _segments_transcribed += 1
+            _inference_total += elapsed
+            _inference_max = max(_inference_max, elapsed)
+            _inference_last = elapsed
+        words_recognised = result.get("text", "").strip()
+        if words_recognised:
+            print("Whisper thinks you said " + words_recognised)
+            transcript.append(words_recognised, _confidence(result))
+
+def _confidence(result: dict) -> float:
+    # average token probability across whisper's segments
+    logprobs = [segment["avg_logprob"] for segment in result.get("segments", []) if "avg_logprob" in segment]
+    if not logprobs:
+        return 1.0
+    return math.exp(sum(logprobs) / len(logprobs))
+
+def _capture() -> None:
+    # opens the microphone once and keeps it open, phrases go straight to the energy gate and whisper queue
+    global _device_opens, _phrases
     r = sr.Recognizer()
     m = sr.Microphone()
-    #with m as source:
-       # r.adjust_for_ambient_noise(source)  # we only need to calibrate once, before we start listening
+    with m as source:
+        _device_opens += 1
+        print("Listening")
+        while not _stop_event.is_set():
+            try:
+                audio = r.listen(source, timeout=LISTEN_TIMEOUT, phrase_time_limit=PHRASE_TIME_LIMIT)
+            except sr.WaitTimeoutError:
+                continue
+            _phrases += 1
+            _queue_segment(audio)
+    print("Stopped listening")
 
-    print("Listening")
-    global stop_listening
-    global words
-    words = ""
-    # start listening in the background (note that we don't have to do this inside a `with` statement)
-    stop_listening = r.listen_in_background(m, callback, phrase_time_limit=None)
-    # `stop_listening` is now a function that, when called, stops background listening
+def start_listening() -> None:
+    # safe to call more than once, the capture thread is only ever started once
+    global _capture_thread, _started_at
+    if _capture_thread is not None and _capture_thread.is_alive():
+        return
+    _stop_event.clear()
+    _started_at = time.time()
+    while len(_workers) < WHISPER_WORKERS:
+        worker = threading.Thread(target=_transcribe_worker, name=f"Whisper-{len(_workers) + 1}", daemon=True)
+        worker.start()
+        _workers.append(worker)
+    _capture_thread = threading.Thread(target=_capture, name="MicCapture", daemon=True)
+    _capture_thread.start()
 
 def stop_listening():
-    global stop_listening
-    stop_listening(wait_for_stop=False)
-    print("Stopped listening")
+    # only needed on shutdown, the microphone stays open between ai_talk ticks
+    global _capture_thread
+    _stop_event.set()
+    if _capture_thread is not None:
+        _capture_thread.join(timeout=LISTEN_TIMEOUT + 5)
+        _capture_thread = None
+    # phrases still waiting are dropped, then one sentinel per live worker, they finish what they're on and exit
+    # (a worker whose whisper failed to load has already exited, so nothing would ever empty a full queue)
+    while True:
+        try:
+            _segments.get_nowait()
+        except queue.Empty:
+            break
+    for _ in range(sum(worker.is_alive() for worker in _workers)):
+        _segments.put_nowait(None)
+    for worker in _workers:
+        worker.join(timeout=5)
+    _workers.clear()
+
+def return_words(since: float = 0.0, until: float | None = None) -> str:
+    # everything recognised after `since` (and up to `until`), the mic is not touched
+    return " ".join(segment.text for segment in transcript.between(since, until))
 
-def return_words() -> str:
-    global words
-    return words
+def stats() -> dict[str, float]:
+    uptime = time.time() - _started_at if _started_at else 0.0
+    with _metrics_lock:
+        return {
+            "device_opens": _device_opens,
+            "device_opens_per_hour": _device_opens / (uptime / 3600) if uptime else 0.0,
+            "phrases": _phrases,
+            "uptime_s": uptime,
+            "segments_skipped": _segments_skipped,
+            "skipped_ratio": _segments_skipped / _phrases if _phrases else 0.0,
+            "segments_dropped": _segments_dropped,
+            "segments_pending": _segments.qsize(),
+            "segments_transcribed": _segments_transcribed,
+            "inference_avg_s": _inference_total / _segments_transcribed if _segments_transcribed else 0.0,
+            "inference_max_s": _inference_max,
+            "inference_last_s": _inference_last,
+        }
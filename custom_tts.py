@@ -1,17 +1,24 @@
 from __future__ import annotations
 from enum import Enum
 from pathlib import Path
+import json
 import threading
 import queue
 import logging
+import time
 import numpy as np
+import onnxruntime
 import sounddevice as sd
-from piper import PiperVoice
+from piper import PiperConfig, PiperVoice
+
+import metrics
+from tts_cache import TTSAudioCache
 
 LOG = logging.getLogger("TTS")
 
 ### OPTIONS ####
 MAX_TTS_QUEUE = int(1e6) #pratically infinite
+MAX_PCM_CHUNKS = 64 # synthesized audio chunks allowed to wait for playback, keeps synthesis from racing ahead
 
 class Voice(Enum):
     HFC_MALE = "en_US-hfc_male-medium.onnx"
@@ -22,24 +29,50 @@ class Voice(Enum):
 
 default_voice = Voice.NORMAN_MALE
 
+### VOICE LOADING OPTIONS ###
+PRELOAD_VOICES: list[Voice] = [Voice.RYAN_MALE]  # loaded and warmed up as soon as the worker starts
+WARM_UP_TEXT = "Warming up."  # synthesized (not played) once per preloaded voice
+# onnxruntime (intra_op, inter_op) thread counts per voice, keeps tts from fighting whisper and ollama for cores
+# voices not listed use DEFAULT_SESSION_THREADS, None leaves onnxruntime to pick
+DEFAULT_SESSION_THREADS: tuple[int, int] | None = (2, 1)
+VOICE_SESSION_THREADS: dict[Voice, tuple[int, int]] = {}
+
 # ---- Worker ---------------------------------------------------------------
 
 class TTSWorker:
     """
-    Single-threaded TTS/audio executor.
+    Two-stage TTS/audio pipeline.
+    - A synthesis thread turns queued text into PCM chunks
+    - A playback thread writes those chunks to one reused output stream
+    - The two are joined by a bounded chunk buffer, so the next line is synthesized while the current one plays
     - Submit text with .speak(text, voice)
     - Optional .clear_pending() to drop queued items
     - Call .stop() on shutdown
     """
     _STOP = object()
+    _END_LINE = object()  # put on the pcm buffer after the last chunk of each line
 
-    def __init__(self, models_dir: str | Path = "tts_voice_files", *, max_queue: int = MAX_TTS_QUEUE) -> None:
+    def __init__(self, models_dir: str | Path = "tts_voice_files", *, max_queue: int = MAX_TTS_QUEUE,
+                 max_pcm_chunks: int = MAX_PCM_CHUNKS, cache: TTSAudioCache | None = None,
+                 preload: list[Voice] | None = None,
+                 session_threads: dict[Voice, tuple[int, int]] | None = None) -> None:
         self.models_dir = Path(models_dir)
-        self.q: "queue.Queue[tuple[Voice, str] | object]" = queue.Queue(maxsize=max_queue)
+        self.preload = PRELOAD_VOICES if preload is None else preload
+        self.session_threads = VOICE_SESSION_THREADS if session_threads is None else session_threads
+        self.ready = threading.Event()  # set once the preloaded voices are loaded and warm
+        # repeated lines are played from here instead of being synthesized again, None turns caching off
+        self.cache = cache
+        # (voice, text, perf_counter() when queued)
+        self.q: "queue.Queue[tuple[Voice, str, float] | object]" = queue.Queue(maxsize=max_queue)
+        # (samplerate, channels, dtype), samples -- filled by the synthesis thread, drained by playback
+        self.pcm: "queue.Queue[tuple[tuple[int, int, str], np.ndarray] | object]" = queue.Queue(maxsize=max_pcm_chunks)
         self.thread = threading.Thread(target=self._run, name="TTSWorker", daemon=True)
+        self.playback_thread = threading.Thread(target=self._play, name="TTSPlayback", daemon=True)
         self._voices: dict[Voice, PiperVoice] = {}   # cache models in-memory
         self._started = False
         self._lock = threading.Lock()                # protects _started only
+        metrics.TTS_QUEUE_DEPTH.set_function(self.q.qsize)
+        metrics.TTS_PCM_DEPTH.set_function(self.pcm.qsize)
 
     # --- lifecycle ---
 
@@ -47,6 +80,7 @@ class TTSWorker:
         with self._lock:
             if self._started:
                 return
+            self.playback_thread.start()
             self.thread.start()
             self._started = True
 
@@ -60,6 +94,7 @@ class TTSWorker:
             self.q.put_nowait(self._STOP)
         if wait:
             self.thread.join(timeout=5)
+            self.playback_thread.join(timeout=5)
 
     # --- API used from the event loop thread ---
 
@@ -67,7 +102,7 @@ class TTSWorker:
         """
         Enqueue a TTS job. Non-blocking by default (drops oldest if queue is full).
         """
-        job = (voice, text)
+        job = (voice, text, time.perf_counter())
         try:
             self.q.put_nowait(job)
         except queue.Full:
@@ -82,13 +117,26 @@ class TTSWorker:
                 pass
             self.q.put_nowait(job)
 
+    def stats(self) -> dict[str, float]:
+        return self.cache.stats() if self.cache is not None else {}
+
     def clear_pending(self) -> None:
-        """Drop any not-yet-played items (does not interrupt the current playback)."""
+        """Drop queued lines and any audio already synthesized but not played yet (the chunk playing now finishes)."""
         try:
             while True:
                 self.q.get_nowait()
         except queue.Empty:
             pass
+        stopping = False
+        try:
+            while True:
+                stopping |= self.pcm.get_nowait() is self._STOP
+        except queue.Empty:
+            pass
+        # the line that was playing got cut short, end it so the playback timing doesn't run on into the next one
+        self.pcm.put(self._END_LINE)
+        if stopping:
+            self.pcm.put(self._STOP)
 
     # --- internals, run only on the worker thread ---
 
@@ -97,49 +145,122 @@ class TTSWorker:
         if mdl is None:
             path = str(self.models_dir / v.value)
             LOG.info("Loading Piper voice: %s", path)
-            mdl = PiperVoice.load(path)
+            threads = self.session_threads.get(v, DEFAULT_SESSION_THREADS)
+            if threads is None:
+                mdl = PiperVoice.load(path)
+            else:
+                # PiperVoice.load doesn't take session options, so the voice is built the same way it would
+                # but around a session with our thread budget (the model is only loaded once)
+                options = onnxruntime.SessionOptions()
+                options.intra_op_num_threads, options.inter_op_num_threads = threads
+                with open(f"{path}.json", "r", encoding="utf-8") as config_file:
+                    config = PiperConfig.from_dict(json.load(config_file))
+                session = onnxruntime.InferenceSession(path, sess_options=options, providers=["CPUExecutionProvider"])
+                mdl = PiperVoice(config=config, session=session)
             self._voices[v] = mdl
         return mdl
 
+    def _preload_voices(self) -> None:
+        # the first synthesis on a fresh session is much slower than the rest, so get it out of the way here
+        for v in self.preload:
+            try:
+                start = time.perf_counter()
+                model = self._get_voice(v)
+                for _ in model.synthesize(WARM_UP_TEXT):
+                    pass
+                LOG.info("Preloaded %s in %.2fs", v.name, time.perf_counter() - start)
+            except Exception as e:
+                LOG.error("Could not preload voice %s: %r", v.name, e)
+        self.ready.set()
+
     def _run(self) -> None:
+        # synthesis stage: text in, PCM chunks out to the playback buffer
         LOG.info("TTS worker started")
-        stream = None
+        self._preload_voices()
         try:
             while True:
                 item = self.q.get()
                 if item is self._STOP:
                     break
 
-                voice, text = item  # type: ignore[assignment]
+                voice, text, queued_at = item  # type: ignore[misc]
+                started = time.perf_counter()
+                metrics.TTS_QUEUE_WAIT_SECONDS.observe(started - queued_at)
                 try:
+                    if self.cache is not None:
+                        cached = self.cache.get(voice.value, text)
+                        if cached is not None:
+                            metrics.TTS_LINES.labels(source="cache").inc()
+                            self.pcm.put(cached)
+                            continue
+
+                    metrics.TTS_LINES.labels(source="synthesized").inc()
                     model = self._get_voice(voice)
-                    # Create/refresh stream per utterance using the first chunk’s format.
-                    stream = None
+                    fmt = None
+                    synthesized = []
                     for chunk in model.synthesize(text):
-                        if stream is None:
-                            dtype = 'int16' if chunk.sample_width == 2 else 'int32'
-                            stream = sd.OutputStream(
-                                samplerate=chunk.sample_rate,
-                                channels=chunk.sample_channels,
-                                dtype=dtype,
-                            )
-                            stream.start()
-
                         # Piper gives 16-bit bytes in audio_int16_bytes when sample_width==2
                         if chunk.sample_width == 2:
+                            fmt = (chunk.sample_rate, chunk.sample_channels, 'int16')
                             data = np.frombuffer(chunk.audio_int16_bytes, dtype=np.int16)
                         else:
+                            fmt = (chunk.sample_rate, chunk.sample_channels, 'int32')
                             data = np.frombuffer(chunk.audio_bytes, dtype=np.int32)
-                        stream.write(data)
+                        # blocks when playback is behind, which keeps cpu use steady instead of bursty
+                        self.pcm.put((fmt, data))
+                        synthesized.append(data)
+                    metrics.TTS_SYNTHESIS_SECONDS.observe(time.perf_counter() - started)
+                    if self.cache is not None and synthesized:
+                        self.cache.put(voice.value, text, fmt, np.concatenate(synthesized))
                 except Exception as e:
                     LOG.exception("TTS job failed: %r", e)
                 finally:
-                    if stream is not None:
-                        try:
-                            stream.stop()
-                            stream.close()
-                        except Exception:
-                            LOG.debug("Stream close failed", exc_info=True)
-                        stream = None
+                    self.pcm.put(self._END_LINE)
         finally:
             LOG.info("TTS worker stopping")
+            self.pcm.put(self._STOP)
+
+    def _play(self) -> None:
+        # playback stage: one output stream, only reopened if a voice with a different format comes along
+        stream = None
+        stream_fmt = None
+        line_started = None
+        try:
+            while True:
+                item = self.pcm.get()
+                if item is self._STOP:
+                    break
+                if item is self._END_LINE:
+                    if line_started is not None:
+                        metrics.TTS_PLAYBACK_SECONDS.observe(time.perf_counter() - line_started)
+                    line_started = None
+                    continue
+
+                fmt, data = item  # type: ignore[misc]
+                if line_started is None:
+                    line_started = time.perf_counter()
+                try:
+                    if stream is None or fmt != stream_fmt:
+                        self._close_stream(stream)
+                        samplerate, channels, dtype = fmt
+                        stream = sd.OutputStream(samplerate=samplerate, channels=channels, dtype=dtype)
+                        stream.start()
+                        stream_fmt = fmt
+                    stream.write(data)
+                except Exception as e:
+                    LOG.exception("TTS playback failed: %r", e)
+                    self._close_stream(stream)
+                    stream = None
+        finally:
+            self._close_stream(stream)
+            LOG.info("TTS playback stopping")
+
+    @staticmethod
+    def _close_stream(stream: sd.OutputStream | None) -> None:
+        if stream is None:
+            return
+        try:
+            stream.stop()
+            stream.close()
+        except Exception:
+            LOG.debug("Stream close failed", exc_info=True)
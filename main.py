@@ -1,26 +1,43 @@
+from __future__ import annotations
+
 import asyncio
 import datetime
+import importlib
 import json
 import logging
 from typing import TYPE_CHECKING
 
 import asqlite
-import speech_recognition
 import twitchio
 from twitchio import eventsub
 from twitchio.ext import commands, routines
-import threading
 import inspect
-import custom_tts
-from custom_tts import Voice
+import time
 
-import ai_responses
-import custom_speech_recognition as sr
+from message_ingest import MessageIngestQueue
+from message_purge import MessagePurger
+from optout_cache import OptOutCache
+import message_store
+import metrics
+import storage
+from chat_context import ChatContextBuffer, CONTEXT_BUFFER_SIZE
+from ai_scheduler import AiScheduler, lift_deadline
+from send_queue import Priority, SendQueue
 
 
 if TYPE_CHECKING:
     import sqlite3
-import os
+
+    import ai_responses
+    import custom_speech_recognition as sr
+    import custom_tts
+else:
+    # the heavy subsystems (ollama, whisper/torch, piper/onnxruntime) are imported in the background by
+    # AiChatBotComponent.start_subsystems, and only if they are switched on
+    ai_responses = sr = custom_tts = None
+
+# perf_counter when this module was loaded, the startup report measures from here
+BOOT_STARTED = time.perf_counter()
 
 # links for the user to allow the bot to work
 '''
@@ -33,10 +50,21 @@ LOGGER: logging.Logger = logging.getLogger("Bot")
 #TODO Make it so that people in the discord can ask it questions
 
 ###### OPTIONS ######
-# add any accounts you want to be ignored by the bot, first is streamelements
-IGNORELIST = [100135110, 161325782]
+# accounts ignored by the bot, set in storage.py so the training export leaves them out too
+IGNORELIST = storage.IGNORED_USERS
 BOT_PREFIX = "!"
 DEBUG_FLAG = False
+STREAM_AI_RESPONSES = True  # speak each sentence as soon as it is generated instead of waiting for the whole reply
+AI_HISTORY_MODE = False  # keep a rolling conversation per channel instead of a fresh prompt every time, !aihistory toggles it
+AI_CHANNELS = None  # channel ids the ai talks in, None means every channel the bot is in
+AI_CHANNEL_INTERVALS = {}  # channel id -> seconds between ai messages, anything missing uses ai_scheduler.DEFAULT_INTERVAL
+TOKEN_VALIDATION_CONCURRENCY = 8  # stored tokens validated with twitch at the same time on startup
+# a token validated this recently (and not close to expiring) is handed to twitchio without asking twitch again,
+# same window twitchio itself uses before revalidating
+TOKEN_REVALIDATE_AFTER = 55 * 60
+TTS_ENABLED = True  # speak the ai messages on the streamer's machine
+MIC_ENABLED = True  # put what the streamer says into the owner channel's prompts
+SPEECH_ACTIVITY_WEIGHT = 3  # a transcribed mic segment counts as this many chat messages when pacing the owner's channel
 
 ### LOADING LOGIN INFORMATION ###
 # the config contains all the login information and should be kept from being seen online
@@ -59,8 +87,9 @@ It contains custom commands.
 '''
 class Bot(commands.AutoBot):
     # Class constructor, we load in all required variables from the config file, and set up the bot
-    def __init__(self, *, token_database: asqlite.Pool, subs: list[eventsub.SubscriptionPayload]) -> None:
-        self.token_database = token_database
+    def __init__(self, *, databases: storage.Storage, subs: list[eventsub.SubscriptionPayload]) -> None:
+        self.databases = databases
+        self.token_database = databases.tokens
         self.debug_option = DEBUG_FLAG
 
         super().__init__(client_id=CLIENT_ID, client_secret=CLIENT_SECRET, bot_id=BOT_ID, owner_id=OWNER_ID, prefix=BOT_PREFIX,
@@ -71,13 +100,19 @@ class Bot(commands.AutoBot):
     The add_component section contains the commands and timers we want to setup, can add more or less if you want the bot to have specific components enabled in it.
     '''
     async def setup_hook(self) -> None:
+        # local /metrics endpoint for the pipeline latency histograms, runs next to the oauth server
+        # the bot doesn't need it, so a taken port only costs the metrics
+        try:
+            metrics.start_server()
+        except OSError as e:
+            LOGGER.warning("Could not start the metrics server, running without it: %r", e)
         # Add our component which contains our commands...
         component = AiChatBotComponent(self)
         await component.setup()
         await self.add_component(component)
         # start timers
         component.ai_reminder.start()
-        component.ai_talk.start()
+        component.prune_messages.start()
 
         # enabled debug messages if debug is on
         if self.debug_option:
@@ -113,25 +148,85 @@ class Bot(commands.AutoBot):
 
     # Returned tokens from the authorisation process are stored in a db
     async def add_token(self, token: str, refresh: str) -> twitchio.authentication.ValidateTokenPayload:
-        # Make sure to call super() as it will add the tokens interally and return us some data...
-        resp: twitchio.authentication.ValidateTokenPayload = await super().add_token(token, refresh)
-
-        # Store our tokens in a simple SQLite Database when they are authorized...
-        query = """
-                INSERT INTO tokens (user_id, token, refresh)
-                VALUES (?, ?, ?) ON CONFLICT(user_id)
-                DO
-                UPDATE SET
-                    token = excluded.token,
-                    refresh = excluded.refresh; \
-                """
-
-        async with self.token_database.acquire() as connection:
-            await connection.execute(query, (resp.user_id, token, refresh))
-
-        LOGGER.info("Added token to the database for user: %s", resp.user_id)
+        resp = await self._validate_token(token, refresh)
+        if resp.user_id:
+            await storage.store_tokens(self.token_database,
+                                       [self._token_row(resp.user_id, resp.expires_in, token, refresh)])
+            LOGGER.info("Added token to the database for user: %s", resp.user_id)
         return resp
 
+    # Make sure to call super() as it will add the tokens interally and return us some data...
+    async def _validate_token(self, token: str, refresh: str) -> twitchio.authentication.ValidateTokenPayload:
+        return await super().add_token(token, refresh)
+
+    # twitchio has no public way to hand it a token that is already validated, so cached tokens go straight into
+    # its token table (the private TokenManager._tokens in twitchio 3.x). None if this twitchio doesn't look like
+    # that, callers then stick to add_token
+    def _token_table(self) -> dict | None:
+        tokens = getattr(self._http, "_tokens", None)
+        if twitchio.__version__.startswith("3.") and isinstance(tokens, dict):
+            return tokens
+        return None
+
+    # the pair twitchio ended up with, which is a new one if it had to refresh while adding
+    def _token_row(self, user_id: str, expires_in: float, token: str, refresh: str) -> tuple:
+        managed = (self._token_table() or {}).get(user_id, {"token": token, "refresh": refresh})
+        return user_id, managed["token"], managed["refresh"], time.time() + expires_in, time.time()
+
+    # twitchio refreshes tokens on its own, the db has to follow or the next start would load dead tokens
+    async def event_token_refreshed(self, payload: twitchio.TokenRefreshedPayload) -> None:
+        await storage.store_tokens(self.token_database, [(payload.user_id, payload.token, payload.refresh_token,
+                                                  time.time() + payload.expires_in, time.time())])
+        LOGGER.info("Stored refreshed token for user: %s", payload.user_id)
+
+    async def load_stored_tokens(self, rows: list[sqlite3.Row]) -> None:
+        """Adds every stored token to the client, replaces calling add_token one at a time.
+
+        Tokens validated within TOKEN_REVALIDATE_AFTER that aren't about to expire are added straight away,
+        twitchio's own validation loop checks them again when they are due. The rest are validated concurrently
+        and written back in one transaction. Every validated row is written, even if its token didn't change,
+        since its new validated_at is what lets the next start skip validating it.
+        """
+        started = time.perf_counter()
+        now = time.time()
+        fresh, stale = [], []
+        table = self._token_table()
+        if table is None:
+            LOGGER.warning("twitchio %s keeps its tokens differently, validating every stored token",
+                           twitchio.__version__)
+        for row in rows:
+            recent = row["validated_at"] and now - row["validated_at"] < TOKEN_REVALIDATE_AFTER
+            # twitchio refreshes anything within an hour of expiring, those have to go through add_token
+            (fresh if table is not None and recent and row["expires_at"] - now > 3600 else stale).append(row)
+        if fresh and not stale:
+            # twitchio only starts its validate/refresh loop from add_token, so one token always goes through it
+            stale.append(fresh.pop())
+        for row in fresh:
+            table[row["user_id"]] = {
+                "user_id": row["user_id"], "token": row["token"], "refresh": row["refresh"],
+                "last_validated": datetime.datetime.fromtimestamp(row["validated_at"]).isoformat()}
+
+        limit = asyncio.Semaphore(TOKEN_VALIDATION_CONCURRENCY)
+        failed = 0
+
+        async def validate(row: sqlite3.Row) -> tuple | None:
+            nonlocal failed
+            async with limit:
+                try:
+                    resp = await self._validate_token(row["token"], row["refresh"])
+                except Exception as e:
+                    failed += 1
+                    LOGGER.warning("Stored token for user %s could not be validated: %r", row["user_id"], e)
+                    return None
+            return self._token_row(resp.user_id, resp.expires_in, row["token"], row["refresh"]) if resp.user_id else None
+
+        results = [result for result in await asyncio.gather(*(validate(row) for row in stale)) if result]
+        validated = time.perf_counter()
+        await storage.store_tokens(self.token_database, results)
+        LOGGER.info("Loaded %d tokens in %.2fs: %d from cache, %d validated in %.2fs, %d failed, saved in %.2fs",
+                    len(rows), time.perf_counter() - started, len(fresh), len(results), validated - started, failed,
+                    time.perf_counter() - validated)
+
     async def event_ready(self) -> None:
         LOGGER.info("Successfully logged in as: %s", self.bot_id)
 
@@ -150,23 +245,146 @@ class AiChatBotComponent(commands.Component):
         # We pass bot here as an example...
         self.bot = bot
         self.IFAI = True
-        self.msg_database = None  # Will be initialized asynchronously
-        self.optout_database = None  # Will be initialized asynchronously
+        self.msg_database = bot.databases.messages
+        self.optout_database = bot.databases.users
+        self.ingest = None  # write-behind queue in front of the message db, created in setup
+        self.purger = None  # background deletes for opt-outs and bans, created in setup
+        self.optouts = OptOutCache(IGNORELIST)  # opted out + ignored users, loaded in setup
+        self.context = ChatContextBuffer()  # recent chat per channel, used to build the ai prompts
         self.user = bot.create_partialuser(user_id=OWNER_ID)
-        # start the bot listening to the mic immediately. Does not start if the ai message generation is off
-        if self.IFAI:
-            sr.start_listening()
-        # start tts worker thread
+        # every outgoing chat message is queued here, rate limited and sent most important first
+        self.outbox = SendQueue(self._send_now)
+        # channel id -> partial user to send chat messages with, the owner's channel is always there
+        self.channels = {str(OWNER_ID): self.user}
+        # one ai loop per channel, sharing a limited number of llm workers
+        # the wait between messages shrinks when chat (or the streamer) is busy and grows when it is quiet
+        self.ai = AiScheduler(self.ai_talk, intervals=AI_CHANNEL_INTERVALS, activity=self.channel_activity)
+        # tts, the mic and the llm start in the background once the databases are up, see start_subsystems
         self.tts = None
+        self._subsystems = None
+        self._mic_cursor = 0  # transcript segments before this have already gone into a prompt
+        self.startup: dict[str, float] = {}  # phase -> seconds, logged once everything is up
+        self.ai_history = AI_HISTORY_MODE
+        self.conversations: dict[str, ai_responses.Conversation] = {}  # channel id -> history, used in history mode
 
     # When the bot is being setup
     async def setup(self):
-        # handles opening both the msgs and user databases
-        self.msg_database = await open_msg_db()
-        self.optout_database = await open_user_db()
-        await self.user.send_message(sender=self.bot.user, message="IM ALIVE!")
-        self.tts = custom_tts.TTSWorker(models_dir="tts_voice_files")
-        self.tts.start()
+        # only what chat handling needs happens here, so the bot can answer chat as soon as it is connected
+        # the databases were opened (and migrated) before the bot started
+        self.startup["databases"] = self.bot.databases.open_seconds
+        started = time.perf_counter()
+        # the opt-outs have to be in before seeding, or opted out users would be back in the prompts after a restart
+        await self.optouts.load(self.optout_database)
+        await self.seed_context()
+        self.startup["chat_state"] = time.perf_counter() - started
+        self.add_channel(OWNER_ID)
+        self.ingest = MessageIngestQueue(self.msg_database)
+        self.ingest.start()
+        # also picks up any purge that was still running when the bot last stopped
+        self.purger = MessagePurger(self.msg_database)
+        self.purger.start()
+        self.outbox.start()
+        self.send_chat("IM ALIVE!")
+        self.startup["chat_ready"] = time.perf_counter() - BOOT_STARTED
+        # the slow parts load in parallel in the background and join in as they become ready
+        self._subsystems = asyncio.create_task(self.start_subsystems())
+
+    async def start_subsystems(self) -> None:
+        """Imports and starts tts, the mic (whisper) and the llm at the same time, then logs the startup report.
+
+        Each one is only loaded if it is switched on, and nothing waits on them: ai_talk skips ticks until the llm
+        is ready, and replies aren't spoken until tts is.
+        """
+        started = time.perf_counter()
+        loaders = {"tts": self._start_tts, "mic": self._start_mic, "llm": self._start_llm}
+        # anything already running (this runs again if !toggleai turns the ai on later) is left alone
+        enabled = {"tts": TTS_ENABLED and self.tts is None, "mic": self.IFAI and MIC_ENABLED and sr is None,
+                   "llm": self.IFAI and ai_responses is None}
+        await asyncio.gather(*(self._timed_start(name, loaders[name]) for name in loaders if enabled[name]))
+        parallel = time.perf_counter() - started
+        sequential = sum(self.startup.get(name, 0.0) for name in loaders)
+        LOGGER.info("Startup report: %s | subsystems ready after %.2fs (%.2fs if loaded one after another), "
+                    "%.2fs since boot", ", ".join(f"{name} {seconds:.2f}s" for name, seconds in self.startup.items()),
+                    parallel, sequential, time.perf_counter() - BOOT_STARTED)
+
+    async def _timed_start(self, name: str, start) -> None:
+        started = time.perf_counter()
+        try:
+            await start()
+        except Exception as e:
+            LOGGER.error("Could not start %s: %r", name, e)
+        self.startup[name] = time.perf_counter() - started
+
+    async def _start_tts(self) -> None:
+        global custom_tts
+        custom_tts = await load_module("custom_tts")
+        tts_cache = await load_module("tts_cache")
+        tts = custom_tts.TTSWorker(models_dir="tts_voice_files", cache=tts_cache.TTSAudioCache())
+        tts.start()
+        # voices are loaded and warmed on the worker's own thread, wait for that so the timing means something
+        await asyncio.to_thread(tts.ready.wait)
+        self.tts = tts
+
+    async def _start_mic(self) -> None:
+        global sr
+        module = await load_module("custom_speech_recognition")
+        self._mic_cursor = module.transcript.cursor
+        module.start_listening()
+        sr = module
+        await asyncio.to_thread(module.whisper_ready.wait)
+
+    async def _start_llm(self) -> None:
+        global ai_responses
+        ai_responses = await load_module("ai_responses")
+        # load the model now so the first ai_talk tick isn't a cold start
+        await self._warm_up_llm()
+
+    # fills the context buffer with the newest stored messages of the channels the ai talks in, so the first prompts
+    # after a restart aren't empty. Opted out users and anyone with a purge still running are left out, and so are
+    # imported chat logs, untimed lines carry the import time and would pass for the newest chat
+    async def seed_context(self) -> None:
+        channels = {str(OWNER_ID)} | {str(c) for c in AI_CHANNELS or ()}
+        excluded = self.optouts.snapshot()
+        now_utc = datetime.datetime.now(datetime.timezone.utc)
+        async with self.msg_database.acquire() as conn:
+            for channel_id in channels:
+                # one channel at a time, each is a short walk back along idx_messages_channel_time
+                rows = await conn.fetchall("""SELECT message_id, user_id, message, time
+                                             FROM messages
+                                             WHERE channel_id = ?
+                                               AND message_id NOT LIKE 'import:%'
+                                               AND user_id NOT IN (SELECT user_id FROM purge_jobs WHERE finished IS NULL)
+                                             ORDER BY time DESC
+                                             LIMIT ?""", (channel_id, CONTEXT_BUFFER_SIZE))
+                for row in reversed(rows):
+                    if row["user_id"] in excluded:
+                        continue
+                    sent = datetime.datetime.strptime(row["time"], "%Y-%m-%d %H:%M:%S").replace(
+                        tzinfo=datetime.timezone.utc)
+                    self.context.add(channel_id, row["message_id"], row["user_id"], row["message"],
+                                     age=(now_utc - sent).total_seconds())
+
+    # registers a channel the bot is chatting in, and starts its ai loop if the ai is meant to talk there
+    def add_channel(self, channel_id: str) -> None:
+        channel_id = str(channel_id)
+        if channel_id not in self.channels:
+            self.channels[channel_id] = self.bot.create_partialuser(user_id=channel_id)
+        if AI_CHANNELS is None or channel_id in {str(c) for c in AI_CHANNELS}:
+            self.ai.add_channel(channel_id)
+
+    # messages per minute in a channel, the owner's channel also counts what the streamer said into the mic
+    def channel_activity(self, channel_id: str, seconds: float) -> float:
+        activity = self.context.rate(channel_id, seconds)
+        if channel_id == str(OWNER_ID) and sr is not None:
+            spoken = sr.transcript.between(time.time() - seconds)
+            activity += len(spoken) * SPEECH_ACTIVITY_WEIGHT * 60 / seconds
+        return activity
+
+    async def _warm_up_llm(self) -> None:
+        try:
+            await ai_responses.warm_up()
+        except Exception as e:
+            LOGGER.error("LLM warm-up failed: %r", e)
 
     # Listens to incoming message events, and processes them
     # Currently stores them in a db with some information that is gathered alongside it
@@ -174,19 +392,21 @@ class AiChatBotComponent(commands.Component):
     async def event_message(self, payload: twitchio.ChatMessage) -> None:
         print(f"[{payload.broadcaster.name}] - {payload.chatter.name}: {payload.text}")
 
-        # check to see if user is opted out
-        if payload.chatter.id == self.bot.bot_id:
-            return  # Ignore messages from the bot itself
-        if IGNORELIST.__contains__(int(payload.chatter.id)):
-            return  # Do not record people on the ignore list
-        # check the excluded users database to see if they opted out
-        async with self.optout_database.acquire() as connection:
-            query = await connection.fetchall("""SELECT *
-                                                 from excluded_users
-                                                 WHERE user_id = ?""", (payload.chatter.id,))
-            # if they have not opted out, store it in the message db
-            if not query:
-                await store_user_msg(self.msg_database, payload.id, payload.chatter.id, payload.text)
+        with metrics.INGEST_SECONDS.time():
+            # check to see if user is opted out
+            if payload.chatter.id == self.bot.bot_id:
+                metrics.MESSAGES.labels(result="own").inc()
+                return  # Ignore messages from the bot itself
+            # covers both the ignore list and anyone who opted out, no db lookup needed
+            if payload.chatter.id in self.optouts:
+                metrics.MESSAGES.labels(result="excluded").inc()
+                return
+            # if they have not opted out, queue it up to be written to the message db
+            if payload.broadcaster.id not in self.channels:
+                self.add_channel(payload.broadcaster.id)
+            self.ingest.put(payload.id, payload.chatter.id, payload.text, payload.broadcaster.id)
+            self.context.add(payload.broadcaster.id, payload.id, payload.chatter.id, payload.text)
+            metrics.MESSAGES.labels(result="stored").inc()
 
     '''
     Upon a message being deleted by a bot, remove it from the db
@@ -209,32 +429,50 @@ class AiChatBotComponent(commands.Component):
         cutoff_utc = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(minutes=30)
         cutoff_str = cutoff_utc.strftime("%Y-%m-%d %H:%M:%S")
 
-        async with self.msg_database.acquire() as conn:
-            await conn.execute("DELETE FROM messages WHERE user_id = ? AND time >= ?", (payload.user.id, cutoff_str), )
-            await conn.commit()
+        # the stored ones are deleted in the background so a big delete never stalls ingest
+        await self.purge_user(payload.user.id, since=cutoff_str, channel_id=payload.broadcaster.id, reason="ban")
+
+    # removes a user from everything in memory right away, then queues a purge job for what is already stored
+    async def purge_user(self, user_id: str, *, since: str | None = None, channel_id: str | None = None,
+                         reason: str = "") -> int:
+        self.context.remove_user(user_id)
+        # their lines would otherwise go back to ollama with every later turn of the history
+        for history_channel, conversation in self.conversations.items():
+            if str(user_id) in conversation.users and channel_id in (None, history_channel):
+                conversation.clear()
+                LOGGER.info("Cleared the ai conversation history of channel %s", history_channel)
+        await self.ingest.discard_user(user_id, since, channel_id)
+        return await self.purger.purge_user(user_id, since=since, channel_id=channel_id, reason=reason)
 
     # helper method for deleting messages from the database
     async def delete_db_message(self, payload):
-        async with self.msg_database.acquire() as connection:
-            await connection.execute("""DELETE
-                                        FROM messages
-                                        WHERE message_id = ?""", (payload.message_id,))
-            LOGGER.info(
-                f"Deleted message from {payload.user.name} in channel {payload.broadcaster.name}: {payload.message_id}")
+        # the ingest queue handles both queued and already written messages
+        await self.ingest.delete_message(payload.message_id)
+        self.context.remove_message(payload.message_id)
+        LOGGER.info(
+            f"Deleted message from {payload.user.name} in channel {payload.broadcaster.name}: {payload.message_id}")
 
 
     @commands.command()
-    async def optout(self, ctx: commands.Context) -> None:
+    async def optout(self, ctx: commands.Context, mode: str | None = None) -> None:
         """Command that adds the user to the exclude list on the message gathering
 
         !optout
+        !optout purge - also deletes every message already collected from them
 
         Accessible by all users
         """
         # stores the user id as well as current presenting username. Will only search using id in future
-        await store_optout_user(self.optout_database, ctx.chatter.id, ctx.chatter.name)
-        await ctx.reply(f"You have been opted out of all future message gathering, {ctx.chatter}!")
-        await ctx.send(f"For more information visit https://link.mrivory124.com/optout")
+        if ctx.chatter.id not in self.optouts:
+            await storage.store_optout_user(self.optout_database, ctx.chatter.id, ctx.chatter.name)
+            self.optouts.add(ctx.chatter.id)
+        self.context.remove_user(ctx.chatter.id)
+        if mode == "purge":
+            await self.purge_user(ctx.chatter.id, reason="opt-out")
+            self.reply(ctx, f"You have been opted out, and your collected messages are being deleted, {ctx.chatter}!")
+        else:
+            self.reply(ctx, f"You have been opted out of all future message gathering, {ctx.chatter}!")
+        self.reply(ctx, "For more information visit https://link.mrivory124.com/optout", as_reply=False)
 
     @commands.command()
     async def toggleai(self, ctx: commands.Context) -> None:
@@ -246,7 +484,38 @@ class AiChatBotComponent(commands.Component):
         """
         if ctx.author.moderator:
             self.IFAI = not self.IFAI
-            await ctx.reply(f"AI message generation: {self.IFAI}")
+            if self.IFAI and ai_responses is None:
+                # it was off at startup, so the llm and mic were never loaded
+                self._subsystems = asyncio.create_task(self.start_subsystems())
+            self.reply(ctx, f"AI message generation: {self.IFAI}")
+
+    @commands.command()
+    async def purges(self, ctx: commands.Context) -> None:
+        """Command that reports the message purges still running
+
+        !purges
+
+        Accessible by moderators only
+        """
+        if ctx.author.moderator:
+            progress = self.purger.progress()
+            if not progress:
+                self.reply(ctx, "No purges running")
+            else:
+                self.reply(ctx, ", ".join(f"job {job}: {deleted} deleted" for job, deleted in progress.items()))
+
+    @commands.command()
+    async def aihistory(self, ctx: commands.Context) -> None:
+        """Command that switches the ai between a rolling conversation and a fresh prompt every message
+
+        !aihistory
+
+        Accessible by moderators only
+        """
+        if ctx.author.moderator:
+            self.ai_history = not self.ai_history
+            self.conversations.clear()  # start fresh either way, an old history would be out of date
+            self.reply(ctx, f"AI conversation history: {self.ai_history}")
 
     @commands.command()
     async def optin(self, ctx: commands.Context) -> None:
@@ -256,9 +525,10 @@ class AiChatBotComponent(commands.Component):
 
         Accessible by all users
         """
-        await remove_optout_user(self.optout_database, ctx.chatter.id)
-        await ctx.reply(f"You have been opted in to all future message gathering, {ctx.chatter}!")
-        await ctx.send(f"For more information visit https://link.mrivory124.com/ai")
+        await storage.remove_optout_user(self.optout_database, ctx.chatter.id)
+        self.optouts.remove(ctx.chatter.id)
+        self.reply(ctx, f"You have been opted in to all future message gathering, {ctx.chatter}!")
+        self.reply(ctx, "For more information visit https://link.mrivory124.com/ai", as_reply=False)
 
     @commands.command()
     async def clip(self, ctx: commands.Context) -> None:
@@ -276,66 +546,194 @@ class AiChatBotComponent(commands.Component):
 
         This routine will wait 30 minutes first after starting, before making the first iteration.
         """
-        await self.user.send_message(sender=self.bot.user,
-                                     message="Chat messages are being collected. You can learn more here: https://link.mrivory124.com/ai")
+        for channel_id in list(self.channels):
+            self.send_chat("Chat messages are being collected. You can learn more here: https://link.mrivory124.com/ai",
+                           channel_id)
 
-    @routines.routine(delta=datetime.timedelta(seconds=12), wait_first=True)
-    async def ai_talk(self) -> None:
-        """A basic routine that sends an ai generated image every 60 seconds.
+    @routines.routine(delta=datetime.timedelta(seconds=message_store.PRUNE_INTERVAL), wait_first=False)
+    async def prune_messages(self) -> None:
+        """A routine that applies the message retention policy, does nothing if RETENTION_DAYS is None.
 
-        This routine will wait 60 seconds first after starting, before making the first iteration.
+        Runs once at startup and then every PRUNE_INTERVAL seconds.
         """
-        if not self.IFAI:
-            return # do not continue if no ai message generation
-
-        # contains the words recognised from the microphone
-        microphone = ""
-
         try:
-            ''' This try method is here because in some cases it does not start
-            listening to the microphone before this is run'''
-            sr.stop_listening()
-            microphone = sr.return_words()
-        except speech_recognition.UnknownValueError as e:
-            print("Microphone couldn't be stopped, wasn't listening to begin with!")
+            await message_store.prune_old_messages(self.msg_database)
+        except Exception as e:
+            LOGGER.error("Message retention pruning failed: %r", e)
 
-        LOGGER.info("Generating message...")
-        # Query the database for a certain amount of messages from users
-        async with self.msg_database.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute("SELECT * FROM messages ORDER BY time DESC LIMIT 5;")
-                rows = await cur.fetchall()
-        # combine those messages into one string to send to the ai generation component
-        prompt_message = ""
-        for r in rows:
-            prompt_message += r['message'] + "\n"
-        # create a thread to get ai generation, then start the mic listening again
-        asyncio.create_task(self._ai_talk_tick(prompt_message, microphone))
-        sr.start_listening()
+    async def ai_talk(self, channel_id: str) -> None:
+        """Sends an ai generated message to a channel, run by that channel's ai scheduler.
+
+        The owner's channel also gets the streamer's microphone in the prompt and the reply spoken out loud.
+        """
+        if not self.IFAI or ai_responses is None:
+            return # do not continue if no ai message generation, or the llm hasn't loaded yet
+
+        is_owner = channel_id == str(OWNER_ID)
+        with metrics.AI_TALK_TICK_SECONDS.time():
+            microphone = ""
+            if is_owner and sr is not None:
+                # the mic stays open between ticks, this only starts it if ai was toggled on after startup
+                sr.start_listening()
+                # contains the words recognised from the microphone since the last tick
+                with metrics.MIC_READ_SECONDS.time():
+                    segments, self._mic_cursor = sr.transcript.read_after(self._mic_cursor)
+                microphone = " ".join(segment.text for segment in segments)
+
+            LOGGER.info("Generating message for channel %s...", channel_id)
+            # take the most recent messages from this channel's in-memory context window, no db read needed
+            rows = self.context.recent(channel_id)
+            conversation = None
+            if self.ai_history:
+                conversation = self.conversations.setdefault(channel_id, ai_responses.Conversation())
+                # the history already has everything sent in earlier turns, only pass on what is new
+                rows = [r for r in rows if r.received > conversation.chat_cursor]
+                if rows:
+                    conversation.chat_cursor = rows[0].received
+            # combine those messages into one string to send to the ai generation component
+            prompt_message = ""
+            for r in rows:
+                prompt_message += r.text + "\n"
+            # older stored messages about whatever the streamer and chat are on about right now
+            with metrics.SEARCH_SECONDS.time():
+                related_rows = await message_store.search_related(
+                    self.msg_database, microphone + " " + prompt_message, channel_id=channel_id,
+                    exclude_ids=[r.message_id for r in rows], exclude_users=self.optouts.snapshot())
+            related = "".join(row["message"] + "\n" for row in related_rows)
+            if conversation is not None:
+                conversation.users.update(r.user_id for r in rows)
+                conversation.users.update(row["user_id"] for row in related_rows)
+        # the scheduler is holding an llm worker for us, so generate right here instead of in a new task
+        await self._ai_talk_tick(channel_id, prompt_message, microphone, related, conversation)
 
     # helper method for ai message generation
-    async def _ai_talk_tick(self, prompt_message: str, streamer_mic_results: str) -> None:
-        try:
-            if inspect.iscoroutinefunction(ai_responses.response_initial):
-                response = await ai_responses.response_initial(prompt_message, streamer_mic_results)
+    async def _ai_talk_tick(self, channel_id: str, prompt_message: str, streamer_mic_results: str,
+                            related: str = "", conversation: ai_responses.Conversation | None = None) -> None:
+        with metrics.AI_TALK_IN_FLIGHT.track_inprogress():
+            if STREAM_AI_RESPONSES:
+                await self._ai_talk_tick_streamed(channel_id, prompt_message, streamer_mic_results, related,
+                                                  conversation)
             else:
-                # run blocking/sync function without blocking the event loop
-                response = await asyncio.to_thread(ai_responses.response_initial, prompt_message, streamer_mic_results)
+                await self._ai_talk_tick_whole(channel_id, prompt_message, streamer_mic_results, related,
+                                               conversation)
+
+    # how much of the prompt ollama actually had to evaluate, history mode should mostly be the new turn only
+    def _record_prompt_eval(self, channel_id: str, stats: dict, conversation) -> None:
+        mode = "history" if conversation is not None else "single"
+        if not stats:
+            # counted so the history/single comparison shows how many replies it is missing
+            metrics.PROMPT_EVAL_MISSING.labels(mode=mode).inc()
+            LOGGER.warning("Channel %s (%s mode): no prompt eval counts for this reply", channel_id, mode)
+            return
+        metrics.PROMPT_EVAL_TOKENS.labels(mode=mode).observe(stats["prompt_eval_count"])
+        metrics.PROMPT_EVAL_SECONDS.labels(mode=mode).observe(stats["prompt_eval_seconds"])
+        LOGGER.info("Channel %s (%s mode): %d prompt tokens evaluated in %.2fs", channel_id, mode,
+                    stats["prompt_eval_count"], stats["prompt_eval_seconds"])
+
+    # tts plays on the streamer's machine, so only the owner's channel gets spoken
+    def _speak(self, channel_id: str, text: str) -> None:
+        if self.tts and channel_id == str(OWNER_ID):
+            self.tts.speak(text, custom_tts.Voice.RYAN_MALE)
+
+    # waits for the whole ai response, then sends and speaks it
+    async def _ai_talk_tick_whole(self, channel_id: str, prompt_message: str, streamer_mic_results: str,
+                                  related: str = "", conversation: ai_responses.Conversation | None = None) -> None:
+        stats = {}
+        try:
+            with metrics.LLM_SECONDS.time():
+                if inspect.iscoroutinefunction(ai_responses.response_initial):
+                    response = await ai_responses.response_initial(prompt_message, streamer_mic_results, related,
+                                                                   conversation, stats)
+                else:
+                    # run blocking/sync function without blocking the event loop
+                    response = await asyncio.to_thread(ai_responses.response_initial, prompt_message, streamer_mic_results,
+                                                       related, conversation, stats)
         except Exception as e:
+            metrics.LLM_FAILURES.inc()
             LOGGER.error("ai_responses.response failed: %r", e)
             return
+        self._record_prompt_eval(channel_id, stats, conversation)
 
         # once the ai message generation is done, send the message
 
-        await self.user.send_message(sender=self.bot.user, message=response)
-        LOGGER.warning("Sent a message %s", response)
-        self.tts.speak(response, Voice.RYAN_MALE)
+        self.send_chat(response, channel_id, Priority.AI)
+        LOGGER.warning("Queued a message %s", response)
+        self._speak(channel_id, response)
+
+    # streams the ai response, every finished sentence goes to tts while the rest is still generating
+    async def _ai_talk_tick_streamed(self, channel_id: str, prompt_message: str, streamer_mic_results: str,
+                                     related: str = "", conversation: ai_responses.Conversation | None = None) -> None:
+        started = time.perf_counter()
+        sentences = []
+        stats = {}
+        try:
+            async for sentence in ai_responses.response_stream(prompt_message, streamer_mic_results, related,
+                                                               conversation, stats):
+                if not sentences:
+                    metrics.LLM_FIRST_SENTENCE_SECONDS.observe(time.perf_counter() - started)
+                    LOGGER.info("First sentence ready after %.2fs", time.perf_counter() - started)
+                    # about to be spoken, cancelling after this would leave a reply that was heard but never posted
+                    lift_deadline()
+                self._speak(channel_id, sentence)
+                sentences.append(sentence)
+        except Exception as e:
+            metrics.LLM_FAILURES.inc()
+            LOGGER.error("ai_responses.response_stream failed: %r", e)
+            return
+        metrics.LLM_SECONDS.observe(time.perf_counter() - started)
+        self._record_prompt_eval(channel_id, stats, conversation)
+        if not sentences:
+            return
+
+        # chat gets the whole reply in one message once generation is done
+        response = " ".join(sentences)
+        self.send_chat(response, channel_id, Priority.AI)
+        LOGGER.warning("Queued a message %s (%.2fs)", response, time.perf_counter() - started)
+
+    # every chat message the component sends goes through here, the returned future resolves to whether it was sent
+    def send_chat(self, message: str, channel_id: str = OWNER_ID, priority: Priority = Priority.BACKGROUND, *,
+                  reply_to: str | None = None) -> asyncio.Future:
+        return self.outbox.put(channel_id, message, priority, reply_to=reply_to)
+
+    # answers a command, ahead of ai chatter and reminders
+    def reply(self, ctx: commands.Context, message: str, *, as_reply: bool = True) -> asyncio.Future:
+        return self.send_chat(message, ctx.broadcaster.id, Priority.COMMAND,
+                              reply_to=ctx.message.id if as_reply else None)
+
+    # called by the send queue once the rate limit allows it
+    async def _send_now(self, channel_id: str, message: str, reply_to: str | None) -> bool:
+        channel = self.channels.get(str(channel_id)) or self.bot.create_partialuser(user_id=channel_id)
+        with metrics.SEND_MESSAGE_SECONDS.time():
+            sent = await channel.send_message(sender=self.bot.user, message=message, reply_to_message_id=reply_to)
+        if not sent.sent:
+            LOGGER.warning("Twitch dropped a message to %s: %s (%s)", channel_id, sent.dropped_message,
+                           sent.dropped_code)
+        return sent.sent
 
     async def teardown(self):
+        await self.ai.stop()
+        await self.outbox.stop()
+        if self._subsystems is not None and not self._subsystems.done():
+            self._subsystems.cancel()
+        if sr is not None:
+            sr.stop_listening()
+            LOGGER.info("Microphone stats: %s", sr.stats())
+        LOGGER.info("Opt-out cache stats: %s", self.optouts.stats())
+        if self.purger:
+            await self.purger.stop()  # unfinished jobs carry on next start
+            self.purger = None
+        if self.ingest:
+            await self.ingest.stop()  # writes out anything still queued
+            self.ingest = None
         if self.tts:
+            LOGGER.info("TTS cache stats: %s", self.tts.stats())
             self.tts.stop()  # signals and join
             self.tts = None
 
+    # twitchio calls this when the component is removed, which happens when the bot closes
+    async def component_teardown(self) -> None:
+        await self.teardown()
+
 '''
     # placeholder to remind me how the structure works
 
@@ -416,113 +814,40 @@ class AiChatBotComponent(commands.Component):
 '''
 
 
-async def setup_database(db: asqlite.Pool) -> tuple[list[tuple[str, str]], list[eventsub.SubscriptionPayload]]:
-    # Create our token table, if it doesn't exist..
-    # You should add the created files to .gitignore or potentially store them somewhere safer
-    # This is just for example purposes...
-
-    query = """CREATE TABLE IF NOT EXISTS tokens
-               (
-                   user_id TEXT PRIMARY KEY,
-                   token TEXT NOT NULL,
-                   refresh TEXT NOT NULL
-               )"""
-
-
-    async with db.acquire() as connection:
-        await connection.execute(query)
+# imports a module on a worker thread, so a slow import (torch, onnxruntime) doesn't stall the event loop
+async def load_module(name: str):
+    return await asyncio.to_thread(importlib.import_module, name)
 
-        # Fetch any existing tokens...
-        rows: list[sqlite3.Row] = await connection.fetchall("""SELECT * from tokens""")
 
-        tokens: list[tuple[str, str]] = []
-        subs: list[eventsub.SubscriptionPayload] = []
-
-        for row in rows:
-            tokens.append((row["token"], row["refresh"]))
+async def setup_database(db: asqlite.Pool) -> tuple[list[sqlite3.Row], list[eventsub.SubscriptionPayload]]:
+    # the tokens table itself is created and migrated by storage.Storage, this loads what is stored in it
+    # You should add the created files to .gitignore or potentially store them somewhere safer
+    tokens = await storage.load_tokens(db)
+    subs: list[eventsub.SubscriptionPayload] = []
 
-            if row["user_id"] == BOT_ID:
-                continue
+    for row in tokens:
+        if row["user_id"] == BOT_ID:
+            continue
 
-            subs.extend([eventsub.ChatMessageSubscription(broadcaster_user_id=row["user_id"], user_id=BOT_ID),
-                eventsub.ChatMessageDeleteSubscription(broadcaster_user_id=row["user_id"], user_id=BOT_ID), ])
+        subs.extend([eventsub.ChatMessageSubscription(broadcaster_user_id=row["user_id"], user_id=BOT_ID),
+            eventsub.ChatMessageDeleteSubscription(broadcaster_user_id=row["user_id"], user_id=BOT_ID), ])
 
     return tokens, subs
 
 
-async def open_user_db() -> asqlite.Pool:
-    user_db_name = "excluded_users.db"
-    if not os.path.exists(user_db_name):
-        # Create the file by opening a connection and closing it
-        async with asqlite.create_pool(user_db_name) as db:
-            async with db.acquire() as conn:
-                await conn.execute("""CREATE TABLE IF NOT EXISTS excluded_users
-                                      (
-                                          user_id TEXT PRIMARY KEY,
-                                          username TEXT
-                                      )""")
-                LOGGER.info("Created new user database: %s", user_db_name)
-    else:
-        LOGGER.info("Using existing user database: %s", user_db_name)
-    return await asqlite.create_pool(user_db_name)
-
-
-# connects to the message database and creates a pool of threads to send information to it
-async def open_msg_db() -> asqlite.Pool:
-    msg_db_name = "messages.db"
-    if not os.path.exists(msg_db_name):
-        # Create the file by opening a connection and closing it
-        async with asqlite.create_pool(msg_db_name) as db:
-            async with db.acquire() as conn:
-                await conn.execute("""CREATE TABLE IF NOT EXISTS messages
-                                      (
-                                          message_id TEXT PRIMARY KEY,
-                                          user_id TEXT NOT NULL,
-                                          message TEXT NOT NULL,
-                                          time TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                                      )""")
-                LOGGER.info("Created new message database: %s", msg_db_name)
-    else:
-        LOGGER.info("Using existing message database: %s", msg_db_name)
-    return await asqlite.create_pool(msg_db_name)
-
-
-
-async def store_user_msg(db: asqlite.Pool, message_id: str, user_id: str, message: str) -> None:
-    # helper method for storing messages in the message.db
-    async with db.acquire() as connection:
-        await connection.execute("""INSERT INTO messages(message_id, user_id, message)
-                                    VALUES (?, ?, ?)""", (message_id, user_id, message))
-
-
-
-async def store_optout_user(db: asqlite.Pool, user_id: str, username: str) -> None:
-    # helper method for storing user optout preferences to the db
-    async with db.acquire() as connection:
-        await connection.execute("""INSERT INTO excluded_users(user_id, username)
-                                    VALUES (?, ?)""", (user_id, username))
-
-
-async def remove_optout_user(db: asqlite.Pool, user_id: str) -> None:
-    # helper method for removing user optout preferences to the db
-    async with db.acquire() as connection:
-        await connection.execute("""DELETE
-                                    FROM excluded_users
-                                    WHERE user_id = ?""", (user_id,))
-
-
 # Our main entry point for our Bot
 # Best to setup_logging here, before anything starts
 def main() -> None:
     twitchio.utils.setup_logging(level=logging.INFO)
 
     async def runner() -> None:
-        async with asqlite.create_pool("tokens.db") as tdb:
-            tokens, subs = await setup_database(tdb)
+        # all three databases open and migrate at the same time, everything stored before channels were
+        # tracked came from the owner's channel
+        async with storage.Storage(legacy_channel_id=OWNER_ID) as databases:
+            tokens, subs = await setup_database(databases.tokens)
 
-            async with Bot(token_database=tdb, subs=subs) as bot:
-                for pair in tokens:
-                    await bot.add_token(*pair)
+            async with Bot(databases=databases, subs=subs) as bot:
+                await bot.load_stored_tokens(tokens)
 
                 await bot.start(load_tokens=False)
 
@@ -0,0 +1,121 @@
+# this file contains the write-behind queue that sits between incoming chat messages and the message db
+import asyncio
+import datetime
+import logging
+
+import asqlite
+
+LOGGER: logging.Logger = logging.getLogger("Ingest")
+
+### OPTIONS ###
+FLUSH_BATCH_SIZE = 200  # flush as soon as this many messages are waiting
+FLUSH_INTERVAL = 2.0  # seconds, anything waiting gets written at least this often
+
+
+def utc_timestamp() -> str:
+    # same format sqlite uses for CURRENT_TIMESTAMP, so queued rows keep the time they arrived at
+    return datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+
+class MessageIngestQueue:
+    """
+    Write-behind buffer for the messages table.
+    - Queue a chat message with .put(message_id, user_id, message, channel_id)
+    - A background task writes everything waiting in one transaction once
+      FLUSH_BATCH_SIZE is hit or FLUSH_INTERVAL has passed
+    - .delete_message() applies to queued rows as well as stored ones, .discard_user() drops queued rows only
+    - Call .stop() on shutdown to flush whatever is left
+    """
+
+    def __init__(self, db: asqlite.Pool, *, batch_size: int = FLUSH_BATCH_SIZE,
+                 flush_interval: float = FLUSH_INTERVAL) -> None:
+        self.db = db
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        # message_id -> (message_id, user_id, message, time, channel_id), dict keeps arrival order and makes discards O(1)
+        self._pending: dict[str, tuple[str, str, str, str, str | None]] = {}
+        self._wake = asyncio.Event()
+        # held while a batch is being written, deletes wait on it so they can't miss an in-flight row
+        self._flush_lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+        self._stopping = False
+
+    # --- lifecycle ---
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name="MessageIngestQueue")
+
+    async def stop(self) -> None:
+        # let the background task finish its current flush and exit, then write out anything still waiting
+        # (it isn't cancelled, a cancel landing mid-transaction would leave the connection inside it)
+        if self._task is not None:
+            self._stopping = True
+            self._wake.set()
+            await self._task
+            self._task = None
+        await self.flush()
+
+    # --- API used from the event handlers ---
+
+    def put(self, message_id: str, user_id: str, message: str, channel_id: str | None = None) -> None:
+        self._pending[message_id] = (message_id, user_id, message, utc_timestamp(), channel_id)
+        if len(self._pending) >= self.batch_size:
+            self._wake.set()
+
+    def pending_count(self) -> int:
+        return len(self._pending)
+
+    async def delete_message(self, message_id: str) -> None:
+        # drop it from the queue if it hasn't been written yet, otherwise delete it from the db
+        if self._pending.pop(message_id, None) is not None:
+            return
+        async with self._flush_lock:
+            async with self.db.acquire() as connection:
+                await connection.execute("""DELETE
+                                            FROM messages
+                                            WHERE message_id = ?""", (message_id,))
+
+    async def discard_user(self, user_id: str, since: str | None = None, channel_id: str | None = None) -> int:
+        # drops a user's queued messages (at or after since, in channel_id if given) before they get written,
+        # then waits out any flush already in progress so a following purge sees every row that made it to the db
+        discarded = 0
+        for message_id, row in list(self._pending.items()):
+            if row[1] == user_id and (since is None or row[3] >= since) and (channel_id is None or row[4] == channel_id):
+                del self._pending[message_id]
+                discarded += 1
+        async with self._flush_lock:
+            pass
+        return discarded
+
+    async def flush(self) -> int:
+        # writes everything waiting in a single transaction, returns how many rows were written
+        async with self._flush_lock:
+            if not self._pending:
+                return 0
+            batch, self._pending = self._pending, {}
+            try:
+                async with self.db.acquire() as connection:
+                    async with connection.transaction():
+                        await connection.executemany("""INSERT OR IGNORE INTO messages(message_id, user_id, message, time, channel_id)
+                                                        VALUES (?, ?, ?, ?, ?)""", list(batch.values()))
+            except Exception:
+                # put the batch back in front of anything that arrived meanwhile so nothing is lost
+                self._pending = {**batch, **self._pending}
+                raise
+            LOGGER.debug("Flushed %d messages", len(batch))
+            return len(batch)
+
+    # --- internals ---
+
+    async def _run(self) -> None:
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                LOGGER.error("Message flush failed, will retry: %r", e)
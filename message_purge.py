@@ -0,0 +1,144 @@
+# this file contains the background job that deletes a user's stored messages after an opt-out or ban
+import asyncio
+import logging
+
+import asqlite
+
+import metrics
+
+LOGGER: logging.Logger = logging.getLogger("Purge")
+
+### OPTIONS ###
+PURGE_BATCH_SIZE = 500  # rows deleted per transaction, small enough that ingest never waits long on the write lock
+PURGE_PAUSE = 0.05  # seconds between batches so ingest and prompt queries get the db in between
+PURGE_LOG_EVERY = 20  # log progress every this many batches on long purges
+PURGE_RETRY = 30.0  # seconds to wait before trying again after a failed batch
+
+# a purge covers stored and archived messages alike
+PURGE_TABLES = ("messages", "messages_archive")
+
+
+class MessagePurger:
+    """
+    Resumable background deletion of a user's messages.
+    - .purge_user(user_id, since=..., channel_id=...) records a job in purge_jobs and returns its id straight away
+    - a background task works through unfinished jobs in PURGE_BATCH_SIZE chunks, saving progress with every chunk,
+      so jobs left over from the last run are picked up again by .start()
+    - .progress() reports the jobs still running
+    - call .stop() on shutdown, the current batch finishes and the rest waits for the next start
+    Removing the user from memory (ingest queue, prompt context) is up to the caller, before queueing the job.
+    """
+
+    def __init__(self, db: asqlite.Pool, *, batch_size: int = PURGE_BATCH_SIZE, pause: float = PURGE_PAUSE) -> None:
+        self.db = db
+        self.batch_size = batch_size
+        self.pause = pause
+        # job_id -> rows deleted so far, for the jobs not finished yet
+        self._active: dict[int, int] = {}
+        self._wake = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._stopping = False
+
+    # --- lifecycle ---
+
+    def start(self) -> None:
+        if self._task is None:
+            self._stopping = False
+            self._wake.set()  # look for jobs left over from the last run
+            self._task = asyncio.create_task(self._run(), name="MessagePurger")
+
+    async def stop(self) -> None:
+        # not cancelled, same as the ingest queue, a cancel mid-transaction would leave the connection inside it
+        if self._task is not None:
+            self._stopping = True
+            self._wake.set()
+            await self._task
+            self._task = None
+
+    # --- API ---
+
+    async def purge_user(self, user_id: str, *, since: str | None = None, channel_id: str | None = None,
+                         reason: str = "") -> int:
+        # since limits it to messages at or after that utc timestamp, channel_id to one channel
+        async with self.db.acquire() as connection:
+            cursor = await connection.execute("""INSERT INTO purge_jobs(user_id, channel_id, since, reason)
+                                                 VALUES (?, ?, ?, ?)""", (str(user_id), channel_id, since, reason))
+            job_id = cursor.get_cursor().lastrowid
+        self._active[job_id] = 0
+        self._wake.set()
+        LOGGER.info("Queued purge job %d for user %s (%s)", job_id, user_id, reason or "no reason")
+        return job_id
+
+    def progress(self) -> dict[int, int]:
+        # job id -> rows deleted so far, for every job that hasn't finished
+        return dict(self._active)
+
+    # --- internals ---
+
+    async def _pending_jobs(self) -> list:
+        async with self.db.acquire() as connection:
+            return await connection.fetchall("""SELECT job_id, user_id, channel_id, since, deleted
+                                                FROM purge_jobs
+                                                WHERE finished IS NULL
+                                                ORDER BY job_id""")
+
+    async def _delete_batch(self, job, table: str) -> int:
+        where = "user_id = ?"
+        params = [job["user_id"]]
+        if job["since"] is not None:
+            where += " AND time >= ?"
+            params.append(job["since"])
+        if job["channel_id"] is not None:
+            where += " AND channel_id = ?"
+            params.append(job["channel_id"])
+        async with self.db.acquire() as connection:
+            async with connection.transaction():
+                cursor = await connection.execute(f"""DELETE
+                                                      FROM {table}
+                                                      WHERE rowid IN (SELECT rowid FROM {table} WHERE {where} LIMIT ?)""",
+                                                  (*params, self.batch_size))
+                deleted = cursor.get_cursor().rowcount
+                # saved in the same transaction as the delete, so the count is right even after a crash
+                await connection.execute("UPDATE purge_jobs SET deleted = deleted + ? WHERE job_id = ?",
+                                         (deleted, job["job_id"]))
+        return deleted
+
+    async def _run_job(self, job) -> bool:
+        # returns False if it was interrupted by stop()
+        job_id = job["job_id"]
+        deleted = self._active[job_id] = job["deleted"]
+        batches = 0
+        for table in PURGE_TABLES:
+            while True:
+                if self._stopping:
+                    return False
+                count = await self._delete_batch(job, table)
+                deleted = self._active[job_id] = deleted + count
+                metrics.PURGED_MESSAGES.inc(count)
+                batches += 1
+                if batches % PURGE_LOG_EVERY == 0:
+                    LOGGER.info("Purge job %d: %d messages deleted so far", job_id, deleted)
+                if count < self.batch_size:
+                    break
+                await asyncio.sleep(self.pause)
+        async with self.db.acquire() as connection:
+            await connection.execute("UPDATE purge_jobs SET finished = CURRENT_TIMESTAMP WHERE job_id = ?", (job_id,))
+        self._active.pop(job_id, None)
+        LOGGER.info("Purge job %d finished, %d messages deleted from user %s", job_id, deleted, job["user_id"])
+        return True
+
+    async def _run(self) -> None:
+        while not self._stopping:
+            await self._wake.wait()
+            self._wake.clear()
+            try:
+                for job in await self._pending_jobs():
+                    if not await self._run_job(job):
+                        break
+            except Exception as e:
+                LOGGER.error("Purge failed, retrying in %.0fs: %r", PURGE_RETRY, e)
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout=PURGE_RETRY)
+                except asyncio.TimeoutError:
+                    pass
+                self._wake.set()
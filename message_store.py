@@ -0,0 +1,170 @@
+# this file contains the schema and upkeep for the messages table (indexes, full-text search, retention pruning)
+# the schema is created and migrated by storage.py
+import asyncio
+import datetime
+import logging
+import re
+import sqlite3
+from collections.abc import Container, Iterable
+
+import asqlite
+
+LOGGER: logging.Logger = logging.getLogger("MessageStore")
+
+### OPTIONS ###
+RETENTION_DAYS = None  # messages older than this get pruned, None keeps everything forever
+RETENTION_ARCHIVE = True  # move pruned messages into messages_archive instead of deleting them outright
+PRUNE_BATCH_SIZE = 500  # rows moved per transaction, kept small so ingest never waits long on the write lock
+PRUNE_INTERVAL = 3600  # seconds between retention runs
+SEARCH_RESULTS = 3  # older messages related to the current chat/mic added to each prompt, 0 turns retrieval off
+SEARCH_MAX_TERMS = 5  # words used per search, the rarest ones win
+SEARCH_MAX_TERM_DOCS = 1000  # words in more messages than this say little about relevance and are slow to rank, so skipped
+
+MESSAGES_SCHEMA = """CREATE TABLE IF NOT EXISTS messages
+                     (
+                         message_id TEXT PRIMARY KEY,
+                         user_id TEXT NOT NULL,
+                         message TEXT NOT NULL,
+                         time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                         channel_id TEXT
+                     )"""
+
+ARCHIVE_SCHEMA = """CREATE TABLE IF NOT EXISTS messages_archive
+                    (
+                        message_id TEXT PRIMARY KEY,
+                        user_id TEXT NOT NULL,
+                        message TEXT NOT NULL,
+                        time TIMESTAMP,
+                        channel_id TEXT
+                    )"""
+
+# one row per user purge (opt-out or ban), progress is saved with every batch so a restart picks up where it stopped
+PURGE_JOBS_SCHEMA = """CREATE TABLE IF NOT EXISTS purge_jobs
+                       (
+                           job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                           user_id TEXT NOT NULL,
+                           channel_id TEXT,
+                           since TIMESTAMP,
+                           reason TEXT,
+                           deleted INTEGER NOT NULL DEFAULT 0,
+                           created TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                           finished TIMESTAMP
+                       )"""
+
+# (time) serves the "newest N messages" prompt query, (user_id, time) serves ban/purge deletes,
+# (channel_id, time) serves the per-channel version of the prompt query, the archive one serves purges
+MESSAGES_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_messages_time ON messages(time)",
+    "CREATE INDEX IF NOT EXISTS idx_messages_user_time ON messages(user_id, time)",
+    "CREATE INDEX IF NOT EXISTS idx_messages_channel_time ON messages(channel_id, time)",
+    "CREATE INDEX IF NOT EXISTS idx_messages_archive_user_time ON messages_archive(user_id, time)",
+]
+
+
+# full-text index over messages.message, kept in step by triggers so every insert/delete path (ingest, imports,
+# purges, pruning) maintains it without knowing about it. It points at messages by rowid, so a VACUUM of the
+# message db needs a 'rebuild' afterwards
+MESSAGES_FTS_SCHEMA = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts
+       USING fts5(message, content='messages', content_rowid='rowid')""",
+    """CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+           INSERT INTO messages_fts(rowid, message) VALUES (new.rowid, new.message);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+           INSERT INTO messages_fts(messages_fts, rowid, message) VALUES ('delete', old.rowid, old.message);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF message ON messages BEGIN
+           INSERT INTO messages_fts(messages_fts, rowid, message) VALUES ('delete', old.rowid, old.message);
+           INSERT INTO messages_fts(rowid, message) VALUES (new.rowid, new.message);
+       END""",
+]
+
+# words that show up in nearly every chat line, never worth a search
+STOPWORDS = frozenset("""the and for you your are was were but not with this that have has had just what when who
+                         how why its it's can cant dont im i'm get got all out about they them then than there
+                         here his her she him our from like lol lmao yeah yes""".split())
+
+
+def search_terms(text: str) -> list[str]:
+    # lowercase words worth searching for, in order of appearance without repeats
+    terms = []
+    for word in re.findall(r"\w+", text.lower()):
+        if len(word) >= 3 and not word.isdigit() and word not in STOPWORDS and word not in terms:
+            terms.append(word)
+    return terms
+
+
+async def search_related(db: asqlite.Pool, text: str, *, channel_id: str | None = None, limit: int = SEARCH_RESULTS,
+                         exclude_ids: Iterable[str] = (), exclude_users: Container[str] = ()) -> list[sqlite3.Row]:
+    # best matching stored messages for text (bm25 ranked), skipping message ids already in the prompt and users
+    # who shouldn't be in one (opted out but not purged yet)
+    terms = search_terms(text)
+    if not terms or limit <= 0:
+        return []
+    exclude_ids = set(exclude_ids)
+    async with db.acquire() as connection:
+        try:
+            # keep the rarest words, common ones match huge numbers of rows and make the ranking slow
+            # counting stops at SEARCH_MAX_TERM_DOCS + 1, so a common word costs no more than a rare one
+            usable = []
+            for term in terms[:SEARCH_MAX_TERMS * 4]:
+                row = await connection.fetchone("""SELECT count(*) AS docs
+                                                   FROM (SELECT rowid FROM messages_fts WHERE messages_fts MATCH ? LIMIT ?)""",
+                                                (f'"{term}"', SEARCH_MAX_TERM_DOCS + 1))
+                if 0 < row["docs"] <= SEARCH_MAX_TERM_DOCS:
+                    usable.append((row["docs"], term))
+            if not usable:
+                return []
+            usable.sort()
+            query = " OR ".join(f'"{term}"' for _, term in usable[:SEARCH_MAX_TERMS])
+            channel_filter = "" if channel_id is None else "AND messages.channel_id = ?"
+            params = (query,) + (() if channel_id is None else (channel_id,))
+            # fetches extra rows to make up for the ones filtered out below
+            rows = await connection.fetchall(f"""SELECT messages.message_id, messages.user_id, messages.message, messages.time
+                                                 FROM messages_fts
+                                                 JOIN messages ON messages.rowid = messages_fts.rowid
+                                                 WHERE messages_fts MATCH ? {channel_filter}
+                                                 ORDER BY messages_fts.rank
+                                                 LIMIT ?""", (*params, limit * 4 + len(exclude_ids)))
+        except sqlite3.OperationalError as e:
+            LOGGER.debug("Full-text search failed: %r", e)
+            return []
+    related = [row for row in rows if row["message_id"] not in exclude_ids and row["user_id"] not in exclude_users]
+    return related[:limit]
+
+
+def retention_cutoff(days: float) -> str:
+    cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=days)
+    return cutoff.strftime("%Y-%m-%d %H:%M:%S")
+
+
+async def prune_old_messages(db: asqlite.Pool, *, days: float | None = RETENTION_DAYS,
+                             archive: bool = RETENTION_ARCHIVE, batch_size: int = PRUNE_BATCH_SIZE) -> int:
+    # removes messages older than the retention window in small batches, returns how many rows went
+    if days is None:
+        return 0
+    cutoff = retention_cutoff(days)
+    total = 0
+    while True:
+        async with db.acquire() as connection:
+            async with connection.transaction():
+                rows = await connection.fetchall("""SELECT rowid
+                                                    FROM messages
+                                                    WHERE time < ?
+                                                    ORDER BY time
+                                                    LIMIT ?""", (cutoff, batch_size))
+                if not rows:
+                    break
+                rowids = [(row["rowid"],) for row in rows]
+                if archive:
+                    await connection.executemany("""INSERT OR IGNORE INTO messages_archive(message_id, user_id, message, time, channel_id)
+                                                    SELECT message_id, user_id, message, time, channel_id
+                                                    FROM messages
+                                                    WHERE rowid = ?""", rowids)
+                await connection.executemany("DELETE FROM messages WHERE rowid = ?", rowids)
+        total += len(rowids)
+        # let ingest and the prompt query get a turn between batches
+        await asyncio.sleep(0)
+    if total:
+        LOGGER.info("%s %d messages older than %s", "Archived" if archive else "Pruned", total, cutoff)
+    return total
@@ -0,0 +1,73 @@
+# this file holds the latency histograms and counters for the whole chat -> ai -> voice pipeline
+# they are served in prometheus text format on a local endpoint next to the oauth web server (port 4343)
+import logging
+
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+LOGGER: logging.Logger = logging.getLogger("Metrics")
+
+### OPTIONS ###
+METRICS_HOST = "127.0.0.1"  # local only, nothing in here is meant for the internet
+METRICS_PORT = 4344  # http://localhost:4344/metrics, None turns the endpoint off
+
+# fast stages (ingest, db, queue waits) sit in the low buckets, llm generation and playback in the high ones
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 40.0)
+
+# --- chat ---
+INGEST_SECONDS = Histogram("bot_ingest_seconds", "Time spent handling one incoming chat message",
+                           buckets=LATENCY_BUCKETS)
+MESSAGES = Counter("bot_messages_total", "Incoming chat messages by what happened to them", ["result"])
+PURGED_MESSAGES = Counter("bot_purged_messages_total", "Messages deleted by opt-out/ban purge jobs")
+
+# --- ai_talk ---
+AI_TALK_TICK_SECONDS = Histogram("bot_ai_talk_tick_seconds", "Time the ai_talk routine itself takes per tick",
+                                 buckets=LATENCY_BUCKETS)
+MIC_READ_SECONDS = Histogram("bot_mic_read_seconds", "Time to read the new transcript segments",
+                             buckets=LATENCY_BUCKETS)
+WHISPER_SECONDS = Histogram("bot_whisper_seconds", "Whisper inference time per speech segment",
+                            buckets=LATENCY_BUCKETS)
+AI_TICKS = Counter("bot_ai_ticks_total", "Scheduled ai ticks by what happened to them", ["result"])
+AI_INTERVAL_SECONDS = Gauge("bot_ai_interval_seconds", "Current activity adjusted wait between ai messages",
+                            ["channel"])
+SEARCH_SECONDS = Histogram("bot_search_seconds", "Full-text search for related messages per tick",
+                           buckets=LATENCY_BUCKETS)
+AI_TALK_IN_FLIGHT = Gauge("bot_ai_talk_in_flight", "_ai_talk_tick tasks currently running")
+LLM_SECONDS = Histogram("bot_llm_seconds", "Time for the whole LLM response", buckets=LATENCY_BUCKETS)
+LLM_FIRST_SENTENCE_SECONDS = Histogram("bot_llm_first_sentence_seconds",
+                                       "Time until the first streamed sentence is ready", buckets=LATENCY_BUCKETS)
+PROMPT_EVAL_TOKENS = Histogram("bot_prompt_eval_tokens", "Prompt tokens ollama had to evaluate per reply", ["mode"],
+                               buckets=(8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096))
+PROMPT_EVAL_SECONDS = Histogram("bot_prompt_eval_seconds", "Time ollama spent evaluating the prompt per reply", ["mode"],
+                                buckets=LATENCY_BUCKETS)
+PROMPT_EVAL_MISSING = Counter("bot_prompt_eval_missing_total", "Replies that finished without ollama's prompt eval counts",
+                              ["mode"])
+LLM_FAILURES = Counter("bot_llm_failures_total", "LLM requests that raised")
+SEND_MESSAGE_SECONDS = Histogram("bot_send_message_seconds", "Time for send_message to return",
+                                 buckets=LATENCY_BUCKETS)
+SEND_QUEUE_SECONDS = Histogram("bot_send_queue_seconds", "Time a chat message waited in the send queue", ["priority"],
+                               buckets=LATENCY_BUCKETS)
+SEND_QUEUE_DEPTH = Gauge("bot_send_queue_depth", "Chat messages waiting in the send queue")
+SEND_DROPPED = Counter("bot_send_dropped_total", "Chat messages not sent, by reason", ["reason"])
+
+# --- tts ---
+TTS_QUEUE_DEPTH = Gauge("bot_tts_queue_depth", "Lines waiting in TTSWorker.q")
+TTS_PCM_DEPTH = Gauge("bot_tts_pcm_buffer_depth", "Synthesized chunks waiting for playback")
+TTS_QUEUE_WAIT_SECONDS = Histogram("bot_tts_queue_wait_seconds", "Time a line waits before synthesis starts",
+                                   buckets=LATENCY_BUCKETS)
+TTS_SYNTHESIS_SECONDS = Histogram("bot_tts_synthesis_seconds", "Time to synthesize one line",
+                                  buckets=LATENCY_BUCKETS)
+TTS_PLAYBACK_SECONDS = Histogram("bot_tts_playback_seconds", "Time from the first to the last chunk of a line played",
+                                 buckets=LATENCY_BUCKETS)
+TTS_LINES = Counter("bot_tts_lines_total", "Lines handled by the TTS worker", ["source"])
+
+_started = False
+
+
+def start_server(host: str = METRICS_HOST, port: int | None = METRICS_PORT) -> None:
+    # runs on its own daemon thread, safe to call more than once
+    global _started
+    if _started or port is None:
+        return
+    start_http_server(port, addr=host)
+    _started = True
+    LOGGER.info("Metrics available at http://%s:%d/metrics", host, port)
@@ -0,0 +1,58 @@
+# this file keeps the opted out users in memory so incoming messages don't need a db lookup
+import logging
+
+import asqlite
+
+LOGGER: logging.Logger = logging.getLogger("OptOut")
+
+
+class OptOutCache:
+    """
+    In-memory copy of the excluded_users table, merged with the ignore list.
+    - Call .load(db) once at setup
+    - .add() / .remove() after writing to the db keep it in sync (write-through)
+    - `user_id in cache` is the hot path check, no db round trip
+    - .snapshot() copies the excluded ids for filtering many rows at once
+    """
+
+    def __init__(self, ignored: list[int] | None = None) -> None:
+        # twitch ids come through as strings on payloads, so everything is stored as str
+        self._ignored: set[str] = {str(user_id) for user_id in (ignored or [])}
+        self._opted_out: set[str] = set()
+        self.hits = 0  # lookups that found an excluded user
+        self.misses = 0  # lookups for users that are fine to store
+
+    async def load(self, db: asqlite.Pool) -> None:
+        async with db.acquire() as connection:
+            rows = await connection.fetchall("""SELECT user_id
+                                                FROM excluded_users""")
+        self._opted_out = {str(row["user_id"]) for row in rows}
+        LOGGER.info("Loaded %d opted out users", len(self._opted_out))
+
+    def add(self, user_id: str) -> None:
+        self._opted_out.add(str(user_id))
+
+    def remove(self, user_id: str) -> None:
+        self._opted_out.discard(str(user_id))
+
+    def snapshot(self) -> set[str]:
+        # every excluded id as a plain set, for bulk filtering that shouldn't count towards hits/misses
+        return self._opted_out | self._ignored
+
+    def __contains__(self, user_id: object) -> bool:
+        user_id = str(user_id)
+        if user_id in self._opted_out or user_id in self._ignored:
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def stats(self) -> dict[str, int]:
+        # every lookup here is a SELECT that no longer hits excluded_users.db
+        return {
+            "opted_out": len(self._opted_out),
+            "ignored": len(self._ignored),
+            "hits": self.hits,
+            "misses": self.misses,
+            "queries_saved": self.hits + self.misses,
+        }
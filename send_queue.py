@@ -0,0 +1,183 @@
+# this file contains the outgoing chat queue, every message the bot sends goes through it
+import asyncio
+import enum
+import heapq
+import itertools
+import logging
+import time
+from collections.abc import Awaitable, Callable
+from dataclasses import dataclass, field
+
+import metrics
+
+LOGGER: logging.Logger = logging.getLogger("SendQueue")
+
+### OPTIONS ###
+# twitch allows 20 messages per 30 seconds for a normal account (100 if the bot is a mod), across every channel
+SEND_RATE = 20 / 30  # messages per second the bucket refills at
+SEND_BURST = 5  # messages that can go out back to back before the rate kicks in, kept low so bursts don't eat the window
+
+
+class Priority(enum.IntEnum):
+    # lower goes first
+    COMMAND = 0  # replies to someone who just typed a command
+    AI = 1  # generated chatter, only worth sending while it is still fresh
+    BACKGROUND = 2  # reminders and status messages
+
+
+# seconds a message may wait in the queue before it is dropped, None waits forever
+MESSAGE_TTL = {Priority.COMMAND: 30.0, Priority.AI: 10.0, Priority.BACKGROUND: None}
+
+# called with (channel_id, message, reply_to_message_id), returns False if twitch didn't accept the message
+SendFunc = Callable[[str, str, str | None], Awaitable[bool]]
+
+
+@dataclass(order=True, slots=True)
+class OutgoingMessage:
+    priority: int
+    seq: int  # keeps messages of the same priority in the order they were queued
+    channel_id: str = field(compare=False)
+    text: str = field(compare=False)
+    reply_to: str | None = field(compare=False)
+    queued_at: float = field(compare=False)
+    deadline: float | None = field(compare=False)
+    result: asyncio.Future = field(compare=False)
+    cancelled: bool = field(default=False, compare=False)
+
+
+class TokenBucket:
+    """Refills at rate tokens a second up to capacity, .take() waits until one is available."""
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self._updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self) -> float:
+        self._refill()
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    async def take(self) -> None:
+        while (wait := self.wait_time()) > 0:
+            await asyncio.sleep(wait)
+        self.tokens -= 1
+
+
+class SendQueue:
+    """
+    Priority queue in front of twitch's send limits.
+    - .put(channel_id, text, priority) queues a message and returns a future that resolves to whether it was sent
+    - messages go out highest priority first, at most SEND_RATE a second with bursts of SEND_BURST
+    - a message still waiting past its deadline (MESSAGE_TTL by priority) is dropped instead of sent late
+    - a new AI message for a channel replaces one still waiting for that channel, and a message identical to
+      one already waiting for the same channel is merged into it
+    - call .stop() on shutdown, anything still waiting is dropped
+    """
+
+    def __init__(self, send: SendFunc, *, rate: float = SEND_RATE, burst: float = SEND_BURST) -> None:
+        self.send = send
+        self.bucket = TokenBucket(rate, burst)
+        self._heap: list[OutgoingMessage] = []
+        self._seq = itertools.count()
+        self._wake = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._stopping = False
+
+    # --- lifecycle ---
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name="SendQueue")
+
+    async def stop(self) -> None:
+        # lets a send already in progress finish, see MessageIngestQueue.stop
+        if self._task is not None:
+            self._stopping = True
+            self._wake.set()
+            await self._task
+            self._task = None
+        while self._heap:
+            message = heapq.heappop(self._heap)
+            if not message.cancelled:
+                self._drop(message, "stopped")
+        metrics.SEND_QUEUE_DEPTH.set(0)
+
+    # --- API ---
+
+    def put(self, channel_id: str, text: str, priority: Priority = Priority.BACKGROUND, *,
+            reply_to: str | None = None, ttl: float | None = ...) -> asyncio.Future:
+        # ttl overrides MESSAGE_TTL for this message, None means no deadline
+        channel_id = str(channel_id)
+        for waiting in self._heap:
+            if waiting.cancelled or waiting.channel_id != channel_id or waiting.priority != priority:
+                continue
+            if waiting.text == text and waiting.reply_to == reply_to:
+                metrics.SEND_DROPPED.labels(reason="coalesced").inc()
+                return waiting.result
+            if priority == Priority.AI:
+                # only the newest generated message for a channel is worth sending
+                waiting.cancelled = True
+                self._drop(waiting, "superseded")
+        if ttl is ...:
+            ttl = MESSAGE_TTL.get(priority)
+        now = time.monotonic()
+        message = OutgoingMessage(int(priority), next(self._seq), channel_id, text, reply_to, now,
+                                  None if ttl is None else now + ttl, asyncio.get_running_loop().create_future())
+        heapq.heappush(self._heap, message)
+        metrics.SEND_QUEUE_DEPTH.set(len(self._heap))
+        self._wake.set()
+        return message.result
+
+    def pending_count(self) -> int:
+        return sum(not message.cancelled for message in self._heap)
+
+    # --- internals ---
+
+    def _drop(self, message: OutgoingMessage, reason: str) -> None:
+        if reason == "deadline":
+            LOGGER.warning("Dropped %s message to %s, it waited too long: %s", Priority(message.priority).name.lower(),
+                           message.channel_id, message.text)
+        metrics.SEND_DROPPED.labels(reason=reason).inc()
+        if not message.result.done():
+            message.result.set_result(False)
+
+    async def _next(self) -> OutgoingMessage | None:
+        # waits for a token first so the message picked is the best one at the moment it can actually go out
+        while not self._stopping:
+            if not self._heap:
+                self._wake.clear()
+                await self._wake.wait()
+                continue
+            await self.bucket.take()
+            while self._heap:
+                message = heapq.heappop(self._heap)
+                metrics.SEND_QUEUE_DEPTH.set(len(self._heap))
+                if message.cancelled:
+                    continue
+                if message.deadline is not None and time.monotonic() > message.deadline:
+                    self._drop(message, "deadline")
+                    continue
+                return message
+            # everything waiting was stale, give the token back
+            self.bucket.tokens += 1
+        return None
+
+    async def _run(self) -> None:
+        while (message := await self._next()) is not None:
+            waited = time.monotonic() - message.queued_at
+            metrics.SEND_QUEUE_SECONDS.labels(priority=Priority(message.priority).name.lower()).observe(waited)
+            try:
+                sent = await self.send(message.channel_id, message.text, message.reply_to)
+            except Exception as e:
+                LOGGER.error("Sending to %s failed: %r", message.channel_id, e)
+                sent = False
+            if not sent:
+                metrics.SEND_DROPPED.labels(reason="rejected").inc()
+            if not message.result.done():
+                message.result.set_result(sent)
@@ -0,0 +1,253 @@
+# this file opens the bot's three sqlite databases (tokens, messages, opted out users), tunes their connections
+# and keeps their schemas up to date
+import asyncio
+import functools
+import logging
+import os
+import sqlite3
+import time
+from collections.abc import Awaitable, Callable
+
+import asqlite
+
+import message_store
+
+LOGGER: logging.Logger = logging.getLogger("Storage")
+
+### OPTIONS ###
+TOKEN_DB = "tokens.db"
+MESSAGE_DB = "messages.db"
+USER_DB = "excluded_users.db"
+# add any accounts you want to be ignored by the bot, first is streamelements. Never stored or exported for training
+IGNORED_USERS = [100135110, 161325782]
+CACHE_SIZE_KB = 64_000  # page cache per connection, the indexes and full-text index stay in memory at this size
+MMAP_SIZE = 256 * 1024 * 1024  # bytes of the message db read through mmap, 0 turns it off
+BUSY_TIMEOUT_MS = 5000  # how long a write waits for another connection's write to finish before failing
+# connections per pool, each one is a thread. In WAL mode reads run alongside a write, writes still go one at a time
+TOKEN_POOL_SIZE = 2  # startup and the odd token refresh
+MESSAGE_POOL_SIZE = 4  # ingest flushes, purges/pruning, the prompt search and context seeding can each have one
+USER_POOL_SIZE = 2  # opt-in/opt-out writes, reads only happen once at startup
+
+# a migration step gets a connection already inside a transaction, the step and the version bump commit together
+Migration = Callable[[asqlite.Connection], Awaitable[None]]
+
+
+def tune_connection(connection: sqlite3.Connection, *, mmap_size: int = 0, cache_size_kb: int = CACHE_SIZE_KB) -> None:
+    # asqlite already sets WAL, it is repeated so nothing depends on that. NORMAL sync only fsyncs at checkpoints
+    # in WAL mode, a power cut can lose the last few commits but never corrupts the db
+    connection.execute("PRAGMA journal_mode = WAL")
+    connection.execute("PRAGMA synchronous = NORMAL")
+    connection.execute(f"PRAGMA cache_size = {-cache_size_kb}")
+    connection.execute(f"PRAGMA mmap_size = {mmap_size}")
+    connection.execute("PRAGMA temp_store = MEMORY")
+    connection.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+
+
+async def add_column(connection, table: str, column: str, declaration: str) -> bool:
+    # sqlite has no ADD COLUMN IF NOT EXISTS, returns True if the column was added
+    columns = [row["name"] for row in await connection.fetchall(f"PRAGMA table_info({table})")]
+    if column in columns:
+        return False
+    await connection.execute(f"ALTER TABLE {table} ADD COLUMN {column} {declaration}")
+    return True
+
+
+async def migrate(db: asqlite.Pool, name: str, migrations: list[Migration]) -> int:
+    """Brings a database up to date, safe (and cheap) to run on every boot.
+
+    The schema version lives in PRAGMA user_version, migration n takes it from n-1 to n. Files from before
+    versioning are at 0 but may already have some of the tables, so steps are written to be safe to run on those.
+    Returns the version the database ends up at.
+    """
+    async with db.acquire() as connection:
+        version = (await connection.fetchone("PRAGMA user_version"))[0]
+        if version > len(migrations):
+            LOGGER.warning("%s is at schema version %d, newer than this code knows (%d)", name, version,
+                           len(migrations))
+            return version
+        for number, step in enumerate(migrations[version:], start=version + 1):
+            async with connection.transaction():
+                await step(connection)
+                await connection.execute(f"PRAGMA user_version = {number}")
+            LOGGER.info("Migrated %s to schema version %d", name, number)
+    return max(version, len(migrations))
+
+
+# --- tokens.db ---
+
+async def _tokens_v1(connection) -> None:
+    await connection.execute("""CREATE TABLE IF NOT EXISTS tokens
+                                (
+                                    user_id TEXT PRIMARY KEY,
+                                    token TEXT NOT NULL,
+                                    refresh TEXT NOT NULL
+                                )""")
+
+
+async def _tokens_v2(connection) -> None:
+    # expires_at/validated_at (unix time) cache the last validation so a quick restart can skip it
+    await add_column(connection, "tokens", "expires_at", "REAL")
+    await add_column(connection, "tokens", "validated_at", "REAL")
+
+
+TOKEN_MIGRATIONS: list[Migration] = [_tokens_v1, _tokens_v2]
+
+
+# --- excluded_users.db ---
+
+async def _users_v1(connection) -> None:
+    await connection.execute("""CREATE TABLE IF NOT EXISTS excluded_users
+                                (
+                                    user_id TEXT PRIMARY KEY,
+                                    username TEXT
+                                )""")
+
+
+USER_MIGRATIONS: list[Migration] = [_users_v1]
+
+
+# --- messages.db ---
+
+async def _messages_v1(connection, *, legacy_channel_id: str | None = None) -> None:
+    # messages stored before channels were tracked all came from one channel, legacy_channel_id fills that in
+    await connection.execute(message_store.MESSAGES_SCHEMA)
+    await connection.execute(message_store.ARCHIVE_SCHEMA)
+    await connection.execute(message_store.PURGE_JOBS_SCHEMA)
+    if await add_column(connection, "messages", "channel_id", "TEXT") and legacy_channel_id is not None:
+        await connection.execute("UPDATE messages SET channel_id = ? WHERE channel_id IS NULL", (legacy_channel_id,))
+        LOGGER.info("Assigned existing messages to channel %s", legacy_channel_id)
+    await add_column(connection, "messages_archive", "channel_id", "TEXT")
+    for index in message_store.MESSAGES_INDEXES:
+        await connection.execute(index)
+
+
+async def _messages_v2(connection) -> None:
+    # builds the full-text index from what is already stored, after that the triggers keep it up to date
+    exists = await connection.fetchone("SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'")
+    try:
+        for statement in message_store.MESSAGES_FTS_SCHEMA:
+            await connection.execute(statement)
+    except sqlite3.OperationalError as e:
+        # the version still moves on, search_related finds no index and prompts just use recent chat
+        LOGGER.warning("Full-text search unavailable, prompts will only use recent chat: %r", e)
+        return
+    if not exists:
+        await connection.execute("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')")
+        LOGGER.info("Built the full-text index over existing messages")
+
+
+async def _messages_v3(connection) -> None:
+    # the training export reads the archive channel by channel in time order
+    await connection.execute("CREATE INDEX IF NOT EXISTS idx_messages_archive_channel_time "
+                             "ON messages_archive(channel_id, time)")
+
+
+def message_migrations(legacy_channel_id: str | None = None) -> list[Migration]:
+    return [functools.partial(_messages_v1, legacy_channel_id=legacy_channel_id), _messages_v2, _messages_v3]
+
+
+async def migrate_messages(db: asqlite.Pool, *, legacy_channel_id: str | None = None) -> int:
+    return await migrate(db, "messages", message_migrations(legacy_channel_id))
+
+
+# --- opening ---
+
+async def open_database(path: str, migrations: list[Migration], *, size: int, mmap_size: int = 0,
+                        cache_size_kb: int = CACHE_SIZE_KB) -> asqlite.Pool:
+    # opens a tuned pool and migrates it, the pool is closed again if the migration fails
+    LOGGER.info("%s database: %s", "Using existing" if os.path.exists(path) else "Created new", path)
+    pool = await asqlite.create_pool(path, size=size, init=functools.partial(
+        tune_connection, mmap_size=mmap_size, cache_size_kb=cache_size_kb))
+    try:
+        await migrate(pool, os.path.basename(path), migrations)
+    except BaseException:
+        await pool.close()
+        raise
+    return pool
+
+
+class Storage:
+    """
+    The bot's databases, one pool each:
+    - .tokens: oauth tokens twitchio loads at startup
+    - .messages: collected chat, the archive, purge jobs and the full-text index
+    - .users: users who opted out
+    Use as `async with Storage(...) as storage:`, all three open (and migrate) at the same time.
+    """
+
+    def __init__(self, *, token_path: str = TOKEN_DB, message_path: str = MESSAGE_DB, user_path: str = USER_DB,
+                 legacy_channel_id: str | None = None) -> None:
+        self.token_path = token_path
+        self.message_path = message_path
+        self.user_path = user_path
+        self.legacy_channel_id = legacy_channel_id  # channel messages from before channels were tracked belong to
+        self.tokens: asqlite.Pool | None = None
+        self.messages: asqlite.Pool | None = None
+        self.users: asqlite.Pool | None = None
+        self.open_seconds = 0.0
+
+    async def open(self) -> None:
+        started = time.perf_counter()
+        pools = await asyncio.gather(
+            open_database(self.token_path, TOKEN_MIGRATIONS, size=TOKEN_POOL_SIZE),
+            open_database(self.message_path, message_migrations(self.legacy_channel_id), size=MESSAGE_POOL_SIZE,
+                          mmap_size=MMAP_SIZE),
+            open_database(self.user_path, USER_MIGRATIONS, size=USER_POOL_SIZE),
+            return_exceptions=True)
+        failed = next((pool for pool in pools if isinstance(pool, BaseException)), None)
+        if failed is not None:
+            await asyncio.gather(*(pool.close() for pool in pools if not isinstance(pool, BaseException)))
+            raise failed
+        self.tokens, self.messages, self.users = pools
+        self.open_seconds = time.perf_counter() - started
+        LOGGER.info("Databases open and migrated in %.2fs", self.open_seconds)
+
+    async def close(self) -> None:
+        pools = [pool for pool in (self.tokens, self.messages, self.users) if pool is not None]
+        self.tokens = self.messages = self.users = None
+        await asyncio.gather(*(pool.close() for pool in pools))
+
+    async def __aenter__(self) -> "Storage":
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.close()
+
+
+# --- queries ---
+
+async def load_tokens(db: asqlite.Pool) -> list[sqlite3.Row]:
+    async with db.acquire() as connection:
+        return await connection.fetchall("""SELECT * FROM tokens""")
+
+
+async def store_tokens(db: asqlite.Pool, rows: list[tuple]) -> None:
+    # rows are (user_id, token, refresh, expires_at, validated_at), written in one transaction
+    if not rows:
+        return
+    async with db.acquire() as connection:
+        async with connection.transaction():
+            await connection.executemany("""INSERT INTO tokens (user_id, token, refresh, expires_at, validated_at)
+                                            VALUES (?, ?, ?, ?, ?) ON CONFLICT(user_id)
+                                            DO
+                                            UPDATE SET
+                                                token = excluded.token,
+                                                refresh = excluded.refresh,
+                                                expires_at = excluded.expires_at,
+                                                validated_at = excluded.validated_at""", rows)
+
+
+async def store_optout_user(db: asqlite.Pool, user_id: str, username: str) -> None:
+    # helper method for storing user optout preferences to the db
+    async with db.acquire() as connection:
+        await connection.execute("""INSERT INTO excluded_users(user_id, username)
+                                    VALUES (?, ?)""", (user_id, username))
+
+
+async def remove_optout_user(db: asqlite.Pool, user_id: str) -> None:
+    # helper method for removing user optout preferences to the db
+    async with db.acquire() as connection:
+        await connection.execute("""DELETE
+                                    FROM excluded_users
+                                    WHERE user_id = ?""", (user_id,))
@@ -0,0 +1,156 @@
+# this file contains the cache of synthesized tts audio, so repeated lines skip piper entirely
+from __future__ import annotations
+import hashlib
+import logging
+import os
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+
+LOG = logging.getLogger("TTSCache")
+
+### OPTIONS ###
+TTS_CACHE_DIR = "tts_cache"
+TTS_CACHE_MEMORY_BYTES = 64 * 1024 * 1024  # in-memory tier, least recently used lines get evicted first
+TTS_CACHE_DISK_BYTES = 512 * 1024 * 1024  # on-disk tier, survives restarts
+
+# (samplerate, channels, dtype) -- same format tuple the TTS pipeline passes to playback
+AudioFormat = tuple[int, int, str]
+
+
+def normalize_text(text: str) -> str:
+    # casing and spacing don't change what piper says, so they shouldn't change the key either
+    return " ".join(text.split()).casefold()
+
+
+class TTSAudioCache:
+    """
+    Content-addressed PCM cache keyed by (voice, normalized text).
+    - .get(voice, text) checks memory, then disk, returns (format, samples) or None
+    - .put(voice, text, format, samples) stores a freshly synthesized line in both tiers
+    - Both tiers are size limited and evict least recently used entries
+    Only used from the TTS synthesis thread.
+    """
+
+    def __init__(self, cache_dir: str | Path | None = TTS_CACHE_DIR, *, memory_bytes: int = TTS_CACHE_MEMORY_BYTES,
+                 disk_bytes: int = TTS_CACHE_DISK_BYTES) -> None:
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self._memory: OrderedDict[str, tuple[AudioFormat, np.ndarray]] = OrderedDict()
+        self._memory_used = 0
+        # key -> file size, oldest first, rebuilt from file mtimes on start
+        self._disk: OrderedDict[str, int] = OrderedDict()
+        self._disk_used = 0
+        self.cache_dir = Path(cache_dir) if cache_dir is not None else None
+        if self.cache_dir is not None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            for path in sorted(self.cache_dir.glob("*.pcm"), key=lambda p: p.stat().st_mtime):
+                size = path.stat().st_size
+                self._disk[path.stem] = size
+                self._disk_used += size
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.bytes_saved = 0  # PCM served from the cache instead of being synthesized
+
+    @staticmethod
+    def key(voice_name: str, text: str) -> str:
+        return hashlib.sha256(f"{voice_name}\0{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+    def get(self, voice_name: str, text: str) -> tuple[AudioFormat, np.ndarray] | None:
+        key = self.key(voice_name, text)
+        entry = self._memory.get(key)
+        if entry is not None:
+            self._memory.move_to_end(key)
+            self.memory_hits += 1
+            self.bytes_saved += entry[1].nbytes
+            return entry
+
+        if key in self._disk:
+            entry = self._read_disk(key)
+            if entry is not None:
+                self._disk.move_to_end(key)
+                self._store_memory(key, entry)
+                self.disk_hits += 1
+                self.bytes_saved += entry[1].nbytes
+                return entry
+
+        self.misses += 1
+        return None
+
+    def put(self, voice_name: str, text: str, fmt: AudioFormat, samples: np.ndarray) -> None:
+        key = self.key(voice_name, text)
+        entry = (fmt, samples)
+        self._store_memory(key, entry)
+        if self.cache_dir is not None:
+            self._write_disk(key, entry)
+
+    def stats(self) -> dict[str, float]:
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+            "bytes_saved": self.bytes_saved,
+            "memory_bytes": self._memory_used,
+            "disk_bytes": self._disk_used,
+        }
+
+    # --- internals ---
+
+    def _store_memory(self, key: str, entry: tuple[AudioFormat, np.ndarray]) -> None:
+        size = entry[1].nbytes
+        if size > self.memory_bytes:
+            return
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_used -= old[1].nbytes
+        self._memory[key] = entry
+        self._memory_used += size
+        while self._memory_used > self.memory_bytes:
+            _, (_, evicted) = self._memory.popitem(last=False)
+            self._memory_used -= evicted.nbytes
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / f"{key}.pcm"
+
+    def _write_disk(self, key: str, entry: tuple[AudioFormat, np.ndarray]) -> None:
+        (samplerate, channels, dtype), samples = entry
+        # tiny text header with the format, then the raw samples
+        header = f"{samplerate},{channels},{dtype}\n".encode("ascii")
+        path = self._path(key)
+        try:
+            tmp = path.with_suffix(".tmp")
+            with open(tmp, "wb") as f:
+                f.write(header)
+                f.write(samples.tobytes())
+            os.replace(tmp, path)
+        except OSError as e:
+            LOG.warning("Could not write TTS cache file %s: %r", path, e)
+            return
+        size = path.stat().st_size
+        self._disk_used -= self._disk.pop(key, 0)
+        self._disk[key] = size
+        self._disk_used += size
+        while self._disk_used > self.disk_bytes and self._disk:
+            evicted, evicted_size = self._disk.popitem(last=False)
+            self._disk_used -= evicted_size
+            try:
+                self._path(evicted).unlink()
+            except OSError:
+                pass
+
+    def _read_disk(self, key: str) -> tuple[AudioFormat, np.ndarray] | None:
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                samplerate, channels, dtype = f.readline().decode("ascii").strip().split(",")
+                samples = np.frombuffer(f.read(), dtype=dtype)
+            os.utime(path)  # keeps eviction order right after a restart
+        except (OSError, ValueError) as e:
+            LOG.warning("Dropping unreadable TTS cache file %s: %r", path, e)
+            self._disk_used -= self._disk.pop(key, 0)
+            return None
+        return (int(samplerate), int(channels), dtype), samples